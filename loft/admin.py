@@ -1,30 +1,106 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.core.files.storage import default_storage
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
 from .models import *
 from .forms import CategoryForm
+from .storage import blob_storage
 
 # Register your models here.
 # admin.site.register(Category)
 # admin.site.register(Product)
 # admin.site.register(ModelProduct)
-admin.site.register(ImagesProduct)
-admin.site.register(Customer)
-admin.site.register(FavoriteProduct)
+admin.site.register(Region)
+admin.site.register(City)
+admin.site.register(StoredBlob)
+admin.site.register(Contact)
+
+
+# Списки ниже выводят __str__ связанных объектов (покупатель, товар), поэтому связи
+# подгружаются одним JOIN через list_select_related, а не запросом на каждую строку
+
+@admin.register(ImagesProduct)
+class ImagesProductAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__')
+    list_select_related = ('product',)
+    raw_id_fields = ('product',)
+
+
+@admin.register(Customer)
+class CustomerAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'phone', 'city')
+    list_select_related = ('user',)
+    search_fields = ('user__username', 'phone')
+
+
+@admin.register(FavoriteProduct)
+class FavoriteProductAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'created_at')
+    list_select_related = ('user', 'product')
+    raw_id_fields = ('user', 'product')
+
 
 # =============  Модели корзины ===============
-admin.site.register(Cart)
-admin.site.register(ProductCart)
+
+@admin.register(Cart)
+class CartAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'created_at')
+    list_select_related = ('customer__user',)
+    raw_id_fields = ('customer',)
+
+
+@admin.register(ProductCart)
+class ProductCartAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'quantity')
+    list_select_related = ('cart__customer__user', 'product')
+    raw_id_fields = ('cart', 'product')
+
 
 # =============  Модели Доставки ===============
-admin.site.register(Delivery)
-admin.site.register(Region)
-admin.site.register(City)
+
+@admin.register(Delivery)
+class DeliveryAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'region', 'city', 'phone', 'status', 'created_at')
+    list_select_related = ('customer__user', 'region', 'city')
+    list_filter = ('status',)
+    raw_id_fields = ('customer', 'region', 'city')
+
 
 # =============  Модели заказов ===============
-admin.site.register(Order)
-admin.site.register(ProductOrder)
-admin.site.register(Contact)
+
+@admin.register(Order)
+class OrderAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'price', 'line_count', 'completed', 'created_at')
+    list_select_related = ('customer__user',)
+    list_filter = ('completed',)
+    raw_id_fields = ('customer', 'cart', 'delivery')
+    date_hierarchy = 'created_at'
+
+
+@admin.register(ProductOrder)
+class ProductOrderAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'quantity', 'total_price')
+    list_select_related = ('order__customer__user',)
+    raw_id_fields = ('order',)
+
+
+@admin.register(Bestseller)
+class BestsellerAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'sold')
+    list_select_related = ('product',)
+    raw_id_fields = ('product',)
+
+
+@admin.register(RelatedProduct)
+class RelatedProductAdmin(admin.ModelAdmin):
+    list_display = ('pk', '__str__', 'score')
+    list_select_related = ('product', 'related')
+    raw_id_fields = ('product', 'related')
 
 
 
@@ -59,6 +135,37 @@ class ImagesProductInline(admin.TabularInline):
     fk_name = 'product'
     extra = 1
 
+# Фильтр по диапазонам цены со скидкой вместо списка всех различных цен
+class PriceBucketFilter(admin.SimpleListFilter):
+    title = 'Цена со скидкой'
+    parameter_name = 'price_bucket'
+    buckets = {
+        'lt10': ('до 10 000', None, 10000),
+        '10-30': ('10 000 - 30 000', 10000, 30000),
+        '30-60': ('30 000 - 60 000', 30000, 60000),
+        '60-100': ('60 000 - 100 000', 60000, 100000),
+        'gte100': ('от 100 000', 100000, None),
+    }
+
+    def lookups(self, request, model_admin):
+        return [(key, label) for key, (label, low, high) in self.buckets.items()]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.buckets:
+            return queryset
+        label, low, high = self.buckets[self.value()]
+        if low is not None:
+            queryset = queryset.filter(final_price__gte=low)
+        if high is not None:
+            queryset = queryset.filter(final_price__lt=high)
+        return queryset
+
+
+# Значение для массовых действий над товарами (скидка, изменение остатка)
+class ProductActionForm(ActionForm):
+    value = forms.IntegerField(required=False, label='Значение')
+
+
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
     list_display = ('pk', 'title', 'price', 'quantity', 'discount', 'category', 'model', 'product_image')
@@ -66,18 +173,65 @@ class ProductAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('title',)}
     inlines = [ImagesProductInline]
     list_editable = ('price', 'quantity', 'discount')
-    list_filter = ('price', 'category', 'model')
+    list_filter = (PriceBucketFilter, 'category', 'model')
+    list_select_related = ('category', 'model')
+    action_form = ProductActionForm
+    actions = ['set_discount', 'adjust_stock']
+
+    # Первое фото товара (миниатюра, если уже создана) подставляется подзапросом в общий SELECT списка
+    def get_queryset(self, request):
+        images = ImagesProduct.objects.filter(product=OuterRef('pk')).order_by('pk')
+        return super(ProductAdmin, self).get_queryset(request).annotate(
+            first_image_name=Subquery(images.values('image')[:1]),
+            first_thumbnail_name=Subquery(images.values('thumbnail')[:1]))
 
     def product_image(self, obj):
-        if obj.images:
-            try:
-                return mark_safe(f'<img src="{obj.images.first().image.url}" width="60" >')
-            except:
-                return 'No image'
+        if getattr(obj, 'first_thumbnail_name', None):
+            url = default_storage.url(obj.first_thumbnail_name)
+        elif getattr(obj, 'first_image_name', None):
+            url = blob_storage.url(obj.first_image_name)
         else:
             return 'No image'
-
-
-
-
-
+        return mark_safe(f'<img src="{url}" width="60" >')
+
+    def get_action_value(self, request):
+        form = self.action_form(request.POST)
+        form.fields['action'].choices = self.get_action_choices(request)
+        if form.is_valid() and form.cleaned_data['value'] is not None:
+            return form.cleaned_data['value']
+        self.message_user(request, 'Укажите значение для действия', messages.ERROR)
+        return None
+
+    # Массовые действия выполняются одним UPDATE без сохранения каждого товара. Сигналы при этом
+    # не срабатывают, но цена и остаток не входят в поисковый индекс, а кэш карточек сбрасывается по updated_at
+    @admin.action(description='Установить скидку, %%')
+    def set_discount(self, request, queryset):
+        value = self.get_action_value(request)
+        if value is None:
+            return
+        if not 0 <= value <= 100:
+            self.message_user(request, 'Скидка должна быть от 0 до 100', messages.ERROR)
+            return
+        updated = queryset.update(discount=value, updated_at=timezone.now())
+        self.message_user(request, f'Скидка {value}% установлена для товаров: {updated}')
+
+    @admin.action(description='Изменить остаток на значение')
+    def adjust_stock(self, request, queryset):
+        value = self.get_action_value(request)
+        if value is None:
+            return
+        updated = queryset.update(quantity=Greatest(F('quantity') + value, Value(0)), updated_at=timezone.now())
+        self.message_user(request, f'Остаток изменён на {value} для товаров: {updated}')
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'name', 'status', 'attempts', 'run_at', 'locked_by', 'created_at')
+    list_display_links = ('pk', 'name')
+    list_filter = ('status', 'name')
+    actions = ['retry_jobs']
+
+    # Повторный запуск задач с ошибкой
+    @admin.action(description='Запустить заново')
+    def retry_jobs(self, request, queryset):
+        queryset.update(status=Job.QUEUED, attempts=0, run_at=timezone.now(), locked_until=None)
@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum, F, Case, When, Value, IntegerField
+from django.utils import timezone
+
+from .models import Bestseller, Product, ProductOrder
+
+# За сколько дней считаются продажи и сколько хитов храним
+BESTSELLER_DAYS = getattr(settings, 'LOFT_BESTSELLER_DAYS', 30)
+BESTSELLER_LIMIT = getattr(settings, 'LOFT_BESTSELLER_LIMIT', 50)
+
+
+# Полный пересчёт хитов продаж по заказам за последние days дней
+def refresh_bestsellers(days=BESTSELLER_DAYS, limit=BESTSELLER_LIMIT):
+    since = timezone.now() - timedelta(days=days)
+    sales = (ProductOrder.objects.filter(order__created_at__gte=since).values('slug')
+             .annotate(sold=Sum('quantity')).order_by('-sold')[:limit])
+    sold = {row['slug']: row['sold'] for row in sales}
+    products = Product.objects.filter(slug__in=sold).values_list('pk', 'slug')
+
+    with transaction.atomic():
+        Bestseller.objects.all().delete()
+        Bestseller.objects.bulk_create([Bestseller(product_id=pk, sold=sold[slug]) for pk, slug in products])
+    return len(products)
+
+
+# Добавляет продажи нового заказа к хитам: вставка недостающих строк и один UPDATE, затем
+# строки сверх limit удаляются, чтобы таблица не росла между полными пересчётами.
+# Выпавшие из окна продажи убираются следующим полным пересчётом
+def add_sales(quantities, limit=BESTSELLER_LIMIT):
+    if not quantities:
+        return
+    Bestseller.objects.bulk_create([Bestseller(product_id=pk) for pk in quantities], ignore_conflicts=True)
+    Bestseller.objects.filter(product_id__in=quantities).update(sold=F('sold') + Case(
+        *[When(product_id=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        default=Value(0), output_field=IntegerField()))
+    extra = list(Bestseller.objects.order_by('-sold', 'product_id').values_list('pk', flat=True)[limit:])
+    if extra:
+        Bestseller.objects.filter(pk__in=extra).delete()
+
+
+def get_bestsellers(limit):
+    return Product.objects.for_cards().filter(bestseller__isnull=False).order_by('-bestseller__sold', 'pk')[:limit]
@@ -0,0 +1,145 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.urls import reverse
+
+from .models import Category, City
+
+
+# =====================  Версионированный кэш =============
+
+# Сколько секунд живёт ключ версии. С кэшем в памяти процесса (LocMemCache) сброс версии в одном
+# процессе не виден остальным, и они отдают старые данные, пока у них не истечёт ключ версии.
+# С общим бэкендом (Redis) сброс виден всем процессам сразу, и срок можно отключить: None
+VERSION_TTL = getattr(settings, 'LOFT_CACHE_VERSION_TTL', 60)
+
+# Сколько живут сами данные. После истечения ключа версии данные старой версии никто не прочитает
+# и не перезапишет, без срока они копились бы в общем кэше (Redis, Memcached) бесконечно
+DATA_TTL = getattr(settings, 'LOFT_CACHE_DATA_TTL', 5 * VERSION_TTL if VERSION_TTL else 60 * 60)
+
+
+# Данные хранятся в кэше под ключом с версией, а версия - отдельным ключом. Сигналы меняют
+# только версию, после чего процессы с тем же кэшем перестраивают данные при первом обращении.
+# Новая версия берётся из текущего времени, поэтому после истечения ключа она не повторяет старую
+def get_version(name):
+    key = f'loft:version:{name}'
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), VERSION_TTL)
+        version = cache.get(key)
+    return version
+
+
+# Данные прежней версии удаляем сразу, они больше не понадобятся
+def bump_version(name):
+    key = f'loft:version:{name}'
+    old = cache.get(key)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), VERSION_TTL)
+    if old is not None:
+        cache.delete(f'loft:{name}:{old}')
+
+
+# Последняя собранная версия данных в памяти процесса: {name: (version, value)}
+_local = {}
+
+
+def get_versioned(name, builder, timeout=DATA_TTL):
+    version = get_version(name)
+    local = _local.get(name)
+    if local and local[0] == version:
+        return local[1]
+
+    key = f'loft:{name}:{version}'
+    value = cache.get(key)
+    if value is None:
+        value = builder()
+        cache.set(key, value, timeout)
+    _local[name] = (version, value)
+    return value
+
+
+# =====================  Дерево категорий =============
+
+# Категория в дереве навигации, повторяет нужные шаблонам методы модели Category
+class CategoryNode:
+    def __init__(self, category):
+        self.pk = category.pk
+        self.title = category.title
+        self.slug = category.slug
+        self.parent_id = category.parent_id
+        self.path = category.path
+        self.depth = category.depth
+        self.url = reverse('category', kwargs={'slug': category.slug})
+        self.icon_url = category.get_icon()
+        self.children = []
+
+    def __str__(self):
+        return self.title
+
+    def get_absolute_url(self):
+        return self.url
+
+    def get_icon(self):
+        return self.icon_url
+
+
+class CategoryTree:
+    def __init__(self, categories):
+        self.by_pk = {category.pk: CategoryNode(category) for category in categories}
+        self.by_slug = {node.slug: node for node in self.by_pk.values()}
+        self.roots = []
+        for node in self.by_pk.values():
+            if node.parent_id is None:
+                self.roots.append(node)
+            elif node.parent_id in self.by_pk:
+                self.by_pk[node.parent_id].children.append(node)
+
+    # Цепочка категорий от корня до указанной включительно, для хлебных крошек
+    def ancestors(self, pk):
+        node = self.by_pk.get(pk)
+        if node is None:
+            return []
+        return [self.by_pk[int(i)] for i in node.path.split('/')[:-1] if int(i) in self.by_pk]
+
+
+def build_category_tree():
+    return CategoryTree(Category.objects.order_by('pk'))
+
+
+# Дерево категорий одним запросом, дальше - из кэша до следующего изменения категорий
+def get_category_tree():
+    return get_versioned('category_tree', build_category_tree)
+
+
+# Состояние дерева для ETag страниц: последнее изменение и кол-во категорий (ловит удаление).
+# Берётся из базы, а не из версии кэша: версия у каждого процесса своя и меняется при истечении ключа
+def category_tree_state():
+    state = Category.objects.aggregate(last=Max('updated_at'), count=Count('pk'))
+    return f'{state["last"]}:{state["count"]}'
+
+
+# =====================  Справочник регионов и городов =============
+
+# {id региона: [[город, id города], ...]} одним запросом для выбора города при оформлении заказа
+def build_regions():
+    regions = {}
+    for region_id, name, pk in City.objects.order_by('region_id', 'name').values_list('region_id', 'name', 'pk'):
+        regions.setdefault(region_id, []).append([name, pk])
+    return regions
+
+
+def get_regions():
+    return get_versioned('regions', build_regions)
+
+
+# Версия справочника для адреса и ETag: последнее изменение и кол-во городов (ловит удаление).
+# Одинакова во всех процессах и не меняется, пока не изменятся города
+def regions_version():
+    state = City.objects.aggregate(last=Max('updated_at'), count=Count('pk'))
+    last = int(state['last'].timestamp() * 1000000) if state['last'] else 0
+    return f'{last}-{state["count"]}'
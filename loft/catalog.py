@@ -0,0 +1,192 @@
+import csv
+import json
+import os
+import shutil
+
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Prefetch
+
+from .models import Category, ModelProduct, Product, ImagesProduct
+from .search import index_products
+from .storage import blob_storage, retain
+
+# Колонки файла каталога: одна строка - один товар вместе с категорией, моделью и фото
+FIELDS = ['slug', 'title', 'description', 'quantity', 'price', 'discount', 'color_name', 'color_code',
+          'width', 'length', 'height', 'category', 'category_title', 'category_parent', 'model', 'model_title',
+          'images']
+INT_FIELDS = ['quantity', 'price', 'discount', 'width', 'length', 'height']
+
+# Поля товара, которые перезаписываются при повторном импорте того же слага
+PRODUCT_FIELDS = ['title', 'description', 'quantity', 'price', 'discount', 'color_name', 'color_code',
+                  'width', 'length', 'height', 'category', 'model', 'updated_at']
+
+# Разделитель списка фото в CSV
+IMAGES_SEPARATOR = '|'
+
+
+class CatalogError(ValueError):
+    pass
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+# Построчное чтение файла каталога, в память целиком он не загружается
+def read_rows(file, fmt):
+    if fmt == 'jsonl':
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+        return
+    for row in csv.DictReader(file):
+        images = row.get('images')
+        if images is not None:
+            row['images'] = [name for name in images.split(IMAGES_SEPARATOR) if name]
+        yield row
+
+
+# Функция записи одной строки в файл каталога
+def row_writer(file, fmt):
+    if fmt == 'jsonl':
+        return lambda row: file.write(json.dumps(row, ensure_ascii=False) + '\n')
+    writer = csv.DictWriter(file, fieldnames=FIELDS)
+    writer.writeheader()
+    return lambda row: writer.writerow(dict(row, images=IMAGES_SEPARATOR.join(row['images'])))
+
+
+# Товары пачками по pk вместе с категорией, моделью и фото: память не растёт с размером каталога
+def export_rows(chunk_size=1000, images_dir=None):
+    products = Product.objects.select_related('category__parent', 'model').prefetch_related(
+        Prefetch('images', queryset=ImagesProduct.objects.only('pk', 'product_id', 'image').order_by('pk')))
+    last_pk = 0
+    while True:
+        chunk = list(products.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not chunk:
+            return
+        for product in chunk:
+            row = {field: getattr(product, field) for field in FIELDS[:11]}
+            row.update({
+                'category': product.category.slug,
+                'category_title': product.category.title,
+                'category_parent': product.category.parent.slug if product.category.parent_id else '',
+                'model': product.model.slug,
+                'model_title': product.model.title,
+                'images': [copy_image(photo.image.name, images_dir) if images_dir else photo.image.name
+                           for photo in product.images.all()],
+            })
+            yield row
+        last_pk = chunk[-1].pk
+
+
+# Копирует фото из хранилища в папку выгрузки, имя в хранилище уже уникально (хэш содержимого)
+def copy_image(name, images_dir):
+    target = os.path.join(images_dir, os.path.basename(name))
+    if not os.path.exists(target):
+        with blob_storage.open(name) as source, open(target, 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+    return os.path.basename(name)
+
+
+# Загрузка каталога с обновлением по слагу. Товары и фото пишутся пачками bulk_create(update_conflicts),
+# каждая пачка - отдельная транзакция. Сигналы при этом не срабатывают, поэтому поисковый индекс
+# и ссылки на файлы обновляются здесь же. Кэш карточек и ETag сбрасываются по updated_at товара
+class CatalogImporter:
+    def __init__(self, images_dir=None):
+        self.images_dir = images_dir and os.path.realpath(images_dir)
+        # Категорий и моделей немного, их слаги держим в памяти весь импорт
+        self.categories = {category.slug: category for category in
+                           Category.objects.only('pk', 'slug', 'title', 'parent_id', 'path', 'depth')}
+        self.models = {slug: (pk, title) for pk, slug, title in ModelProduct.objects.values_list('pk', 'slug', 'title')}
+
+    # Категории сохраняются по одной через save(), чтобы пересчитать путь в дереве
+    def get_category(self, slug, title=None, parent_slug=None):
+        parent = self.get_category(parent_slug) if parent_slug else None
+        category = self.categories.get(slug)
+        if category is None:
+            category = Category(slug=slug, title=title or slug, parent=parent)
+        elif (title and category.title != title) or (parent and category.parent_id != parent.pk):
+            category.title = title or category.title
+            category.parent = parent or category.parent
+        else:
+            return category
+        category.save()
+        self.categories[slug] = category
+        return category
+
+    def save_models(self, rows):
+        changed = {}
+        for row in rows:
+            slug = row.get('model')
+            title = row.get('model_title') or slug
+            if not slug:
+                continue
+            if slug not in self.models or (row.get('model_title') and self.models[slug][1] != title):
+                changed[slug] = title
+        if not changed:
+            return
+        ModelProduct.objects.bulk_create([ModelProduct(slug=slug, title=title) for slug, title in changed.items()],
+                                         update_conflicts=True, unique_fields=['slug'], update_fields=['title'])
+        for pk, slug, title in ModelProduct.objects.filter(slug__in=changed).values_list('pk', 'slug', 'title'):
+            self.models[slug] = (pk, title)
+
+    def make_product(self, number, row):
+        try:
+            values = {field: int(row[field]) for field in INT_FIELDS}
+            category = self.get_category(row['category'], row.get('category_title'), row.get('category_parent') or None)
+            return Product(slug=row['slug'], title=row['title'], description=row.get('description') or '',
+                           color_name=row.get('color_name') or 'Белый', color_code=row.get('color_code') or '#ffffff',
+                           category=category, model_id=self.models[row['model']][0], **values)
+        except (KeyError, TypeError, ValueError) as error:
+            raise CatalogError(f'Строка {number}: {error!r}')
+
+    # Путь к файлу из папки с фото загружается в хранилище, остальные значения - уже готовые имена в хранилище
+    def resolve_image(self, value):
+        if self.images_dir:
+            path = os.path.realpath(os.path.join(self.images_dir, value))
+            if path.startswith(self.images_dir + os.sep) and os.path.isfile(path):
+                field = ImagesProduct._meta.get_field('image')
+                with open(path, 'rb') as file:
+                    return blob_storage.save(field.generate_filename(None, os.path.basename(path)), File(file))
+        return value
+
+    # Фото из файла заменяют фото товара: лишние удаляются, новые добавляются одним INSERT.
+    # Если колонки images нет, фото товара не трогаются
+    def save_images(self, rows, pks):
+        wanted = {pks[row['slug']]: [self.resolve_image(name) for name in row['images']]
+                  for row in rows if row.get('images') is not None}
+        if not wanted:
+            return
+        existing = {}
+        to_delete = []
+        for pk, product_id, name in ImagesProduct.objects.filter(product_id__in=wanted).values_list(
+                'pk', 'product_id', 'image'):
+            if name in wanted[product_id] and name not in existing.setdefault(product_id, set()):
+                existing[product_id].add(name)
+            else:
+                to_delete.append(pk)
+        if to_delete:
+            ImagesProduct.objects.filter(pk__in=to_delete).delete()
+
+        new_images = [ImagesProduct(product_id=product_id, image=name) for product_id, names in wanted.items()
+                      for name in dict.fromkeys(names) if name not in existing.get(product_id, ())]
+        ImagesProduct.objects.bulk_create(new_images)
+        retain(photo.image.name for photo in new_images)
+
+    # Одна пачка строк: модели, категории, товары и фото в одной транзакции. Возвращает кол-во товаров
+    def import_chunk(self, numbered_rows):
+        # Повтор слага внутри пачки: остаётся последняя строка, иначе upsert затронет строку дважды
+        rows = {row['slug']: (number, row) for number, row in numbered_rows if row.get('slug')}
+        with transaction.atomic():
+            self.save_models(row for number, row in rows.values())
+            products = [self.make_product(number, row) for number, row in rows.values()]
+            Product.objects.bulk_create(products, update_conflicts=True, unique_fields=['slug'],
+                                        update_fields=PRODUCT_FIELDS)
+            pks = dict(Product.objects.filter(slug__in=rows).values_list('slug', 'pk'))
+            self.save_images([row for number, row in rows.values()], pks)
+            # Индекс пишется в той же транзакции: построчные записи в автокоммите в разы медленнее
+            index_products(Product.objects.filter(pk__in=pks.values()))
+        return len(products)
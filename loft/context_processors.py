@@ -0,0 +1,13 @@
+from django.utils.functional import SimpleLazyObject
+
+from .utils import get_favorite_ids, get_cart_quantity
+
+
+# Множество id избранных товаров пользователя, запрос выполняется только при первом обращении
+def favorites(request):
+    return {'favorite_ids': SimpleLazyObject(lambda: get_favorite_ids(request))}
+
+
+# Кол-во товаров в корзине для значка в шапке, считается при первом обращении
+def cart(request):
+    return {'cart_badge': SimpleLazyObject(lambda: get_cart_quantity(request))}
@@ -0,0 +1,37 @@
+from itertools import accumulate
+
+from django.db.models import Count, F
+
+from .utils import filter_products
+
+# Шаг ценовых интервалов фильтра
+PRICE_STEP = 500
+
+
+# Фасеты фильтра категории: кол-во товаров по моделям, цветам и ценам.
+# Каждый фасет считается одним GROUP BY с учётом всех фильтров, кроме своего собственного
+def get_facets(request, products):
+    facets = {
+        'colors': list(filter_products(request, products, exclude=('color',))
+                       .values('color_name', 'color_code').annotate(count=Count('pk')).order_by('color_name')),
+    }
+    facets.update(get_price_facets(filter_products(request, products, exclude=('price_from', 'price_to'))))
+    if request.GET.get('cat'):
+        facets['models'] = list(filter_products(request, products, exclude=('model',))
+                                .values('model__slug', 'model__title')
+                                .annotate(count=Count('pk')).order_by('model__title'))
+    return facets
+
+
+# Варианты «Цена от» и «Цена до» с кол-вом товаров, которые останутся после выбора
+def get_price_facets(products):
+    floor = list(products.values(bucket=F('final_price') / PRICE_STEP)
+                 .annotate(count=Count('pk')).order_by('-bucket'))
+    ceil = list(products.values(bucket=(F('final_price') + PRICE_STEP - 1) / PRICE_STEP)
+                .annotate(count=Count('pk')).order_by('bucket'))
+
+    price_from = [{'price': row['bucket'] * PRICE_STEP, 'count': count}
+                  for row, count in zip(floor, accumulate(row['count'] for row in floor))]
+    price_to = [{'price': row['bucket'] * PRICE_STEP, 'count': count}
+                for row, count in zip(ceil, accumulate(row['count'] for row in ceil))]
+    return {'price_from': price_from[::-1], 'price_to': price_to}
@@ -3,6 +3,10 @@ from .models import Category, Delivery, Customer, Contact
 from django_svg_image_form_field import SvgAndImageFormField
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
 from django.contrib.auth.models import User
+from django.conf import settings
+
+# Максимальный размер файла в обращении покупателя
+CONTACT_MAX_UPLOAD = getattr(settings, 'LOFT_CONTACT_MAX_UPLOAD', 5 * 1024 * 1024)
 
 
 class CategoryForm(forms.ModelForm):
@@ -138,6 +142,13 @@ class ContactForm(forms.ModelForm):
         model = Contact
         fields = ('full_name', 'phone', 'text', 'photo')
 
+    # Ограничение размера файла, чтобы обращения не забивали хранилище
+    def clean_photo(self):
+        photo = self.cleaned_data.get('photo')
+        if photo and photo.size > CONTACT_MAX_UPLOAD:
+            raise forms.ValidationError(f'Файл больше {CONTACT_MAX_UPLOAD // (1024 * 1024)} МБ')
+        return photo
+
 
 
 
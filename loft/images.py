@@ -0,0 +1,118 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .caching import bump_version
+from .jobs import job
+from .models import ImagesProduct, Category, Product
+from .storage import blob_storage
+
+# Размеры вариантов: миниатюра для карточек и корзины, иконка для меню
+THUMBNAIL_SIZE = (400, 400)
+ICON_SIZE = (64, 64)
+
+# Варианты: {поле: (размер, формат, расширение)}
+PRODUCT_VARIANTS = {
+    'thumbnail': (THUMBNAIL_SIZE, 'JPEG', '.jpg'),
+    'thumbnail_webp': (THUMBNAIL_SIZE, 'WEBP', '.webp'),
+    'webp': (None, 'WEBP', '.webp'),
+}
+ICON_VARIANTS = {
+    'icon_thumbnail': (ICON_SIZE, 'PNG', '.png'),
+    'icon_webp': (ICON_SIZE, 'WEBP', '.webp'),
+}
+
+# Пул потоков для массовой обработки командой generate_image_variants
+executor = ThreadPoolExecutor(max_workers=getattr(settings, 'LOFT_IMAGE_WORKERS', 2))
+
+
+# Сжимает изображение до size (или оставляет размер, если size=None) и кодирует в нужный формат
+def render_variant(field_file, size, image_format):
+    field_file.open('rb')
+    try:
+        image = ImageOps.exif_transpose(Image.open(field_file))
+        if size:
+            image.thumbnail(size)
+        if image_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        buffer = BytesIO()
+        image.save(buffer, image_format, quality=85)
+        return ContentFile(buffer.getvalue())
+    finally:
+        field_file.close()
+
+
+def variant_name(name, extension):
+    return os.path.splitext(os.path.basename(name))[0] + extension
+
+
+# Вариант фото уже создан из текущего файла, если его имя без расширения совпадает с именем оригинала
+# (для фото из blob_storage это хэш содержимого)
+def is_variant_of(variant, original):
+    return bool(variant) and (os.path.splitext(os.path.basename(variant.name))[0] ==
+                              os.path.splitext(os.path.basename(original.name))[0])
+
+
+# Иконку нужно обработать: она есть, это не SVG, и варианты сделаны не из неё
+def icon_variants_outdated(category):
+    return (bool(category.icon) and not category.icon.name.lower().endswith('.svg') and
+            category.icon.name != category.icon_source)
+
+
+# Сохраняет варианты original в поля instance, возвращает {поле: имя файла}.
+# Имя оригинала из blob_storage - хэш содержимого, поэтому вариант с таким именем уже сделан
+# из того же файла: строки с одинаковым фото используют общие варианты
+def save_variants(instance, original, variants):
+    names = {}
+    for field, (size, image_format, extension) in variants.items():
+        variant = getattr(instance, field)
+        name = variant.field.generate_filename(instance, variant_name(original.name, extension))
+        if original.storage is blob_storage and variant.storage.exists(name):
+            names[field] = name
+        else:
+            names[field] = variant.storage.save(name, render_variant(original, size, image_format))
+    return names
+
+
+# Удаляет варианты фото вместе с оригиналом, когда сборщик удаляет его из хранилища
+def delete_product_variants(name):
+    for field, (size, image_format, extension) in PRODUCT_VARIANTS.items():
+        field = ImagesProduct._meta.get_field(field)
+        field.storage.delete(field.generate_filename(None, variant_name(name, extension)))
+
+
+@job('images.product_variants')
+def make_product_image_variants(image_id):
+    photo = ImagesProduct.objects.filter(pk=image_id).first()
+    if photo is None or not photo.image:
+        return
+    names = save_variants(photo, photo.image, PRODUCT_VARIANTS)
+    # Через update, чтобы не вызывать сигналы сохранения повторно, и сбрасываем кэш карточки
+    ImagesProduct.objects.filter(pk=image_id).update(**names)
+    Product.objects.filter(pk=photo.product_id).update(updated_at=timezone.now())
+
+
+@job('images.category_icon_variants')
+def make_category_icon_variants(category_id):
+    category = Category.objects.filter(pk=category_id).first()
+    if category is None or not category.icon or category.icon.name.lower().endswith('.svg'):
+        return
+    names = save_variants(category, category.icon, ICON_VARIANTS)
+    # Варианты записываются, только если иконку не заменили, пока они создавались
+    Category.objects.filter(pk=category_id, icon=category.icon.name).update(
+        icon_source=category.icon.name, updated_at=timezone.now(), **names)
+    bump_version('category_tree')
+
+
+# Выполняет задачу в фоновом потоке и освобождает соединение с базой после неё
+def run_task(func, pk):
+    try:
+        func(pk)
+    finally:
+        connection.close()
@@ -0,0 +1,138 @@
+import logging
+import os
+import random
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд задача считается занятой обработчиком. Если процесс упал, не закончив её,
+# по истечении этого времени задачу заберёт другой обработчик
+VISIBILITY_TIMEOUT = getattr(settings, 'LOFT_JOBS_VISIBILITY_TIMEOUT', 300)
+
+# Задержка перед повтором: BACKOFF_BASE * 2^(попытка - 1) секунд, но не больше BACKOFF_MAX
+BACKOFF_BASE = getattr(settings, 'LOFT_JOBS_BACKOFF_BASE', 10)
+BACKOFF_MAX = getattr(settings, 'LOFT_JOBS_BACKOFF_MAX', 60 * 60)
+
+# Выполнять задачи сразу после коммита в том же процессе, без обработчика (для разработки)
+JOBS_EAGER = getattr(settings, 'LOFT_JOBS_EAGER', False)
+
+# Зарегистрированные задачи: {имя: функция}
+registry = {}
+
+
+# Декоратор регистрации задачи. Функция остаётся обычной, а func.delay(*args) ставит её в очередь
+def job(name, max_attempts=5):
+    def decorator(func):
+        registry[name] = func
+        func.delay = lambda *args, **options: enqueue(name, *args, max_attempts=max_attempts, **options)
+        return func
+    return decorator
+
+
+# Постановка задачи в очередь. Строка создаётся в текущей транзакции, поэтому обработчик
+# увидит задачу только вместе с данными, ради которых она поставлена
+def enqueue(name, *args, run_at=None, max_attempts=5):
+    if name not in registry:
+        raise KeyError(f'Неизвестная задача: {name}')
+    if JOBS_EAGER:
+        transaction.on_commit(lambda: registry[name](*args))
+        return None
+    return Job.objects.create(name=name, payload={'args': list(args)}, run_at=run_at or timezone.now(),
+                              max_attempts=max_attempts)
+
+
+def backoff(attempts):
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+# Условие «задачу можно взять»: она ждёт в очереди, либо обработчик не успел её закончить вовремя
+# и попытки ещё остались
+def available(now):
+    return (Q(status=Job.QUEUED, run_at__lte=now) |
+            Q(status=Job.RUNNING, locked_until__lt=now, attempts__lt=F('max_attempts')))
+
+
+# Задача, которая каждый раз роняет обработчик (нехватка памяти, сбой в PIL), не доходит до run
+# и не может сама записать ошибку. После последней попытки она помечается ошибкой здесь
+def fail_abandoned(now):
+    return Job.objects.filter(status=Job.RUNNING, locked_until__lt=now, attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED, locked_until=None, last_error='Обработчик не завершил задачу за отведённое время')
+
+
+# Забирает до limit задач. Каждая задача занимается условным UPDATE: если два обработчика
+# выбрали одну и ту же строку, UPDATE пройдёт только у одного из них
+def claim(worker, limit=10):
+    now = timezone.now()
+    fail_abandoned(now)
+    claimed = []
+    for pk in Job.objects.filter(available(now)).order_by('run_at', 'pk').values_list('pk', flat=True)[:limit]:
+        updated = Job.objects.filter(available(now), pk=pk).update(
+            status=Job.RUNNING, locked_by=worker, locked_until=now + timedelta(seconds=VISIBILITY_TIMEOUT),
+            attempts=F('attempts') + 1)
+        if updated:
+            claimed.append(pk)
+    return list(Job.objects.filter(pk__in=claimed, locked_by=worker).order_by('run_at', 'pk'))
+
+
+# Выполняет задачу: при успехе строка удаляется, при ошибке задача ждёт повтора или помечается ошибкой.
+# Результат записывается, только если задача всё ещё за этим обработчиком
+def run(job_obj, worker):
+    mine = Job.objects.filter(pk=job_obj.pk, locked_by=worker)
+    func = registry.get(job_obj.name)
+    try:
+        if func is None:
+            raise KeyError(f'Неизвестная задача: {job_obj.name}')
+        func(*job_obj.payload.get('args', []))
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning('Задача %s №%s завершилась ошибкой', job_obj.name, job_obj.pk, exc_info=True)
+        if func is None or job_obj.attempts >= job_obj.max_attempts:
+            mine.update(status=Job.FAILED, locked_until=None, last_error=error)
+        else:
+            mine.update(status=Job.QUEUED, locked_until=None, last_error=error,
+                        run_at=timezone.now() + backoff(job_obj.attempts))
+        return False
+    mine.delete()
+    return True
+
+
+# Выполняет все задачи, готовые к запуску, и возвращает их кол-во
+def run_pending(worker=None, batch=10):
+    worker = worker or worker_name()
+    done = 0
+    while True:
+        jobs = claim(worker, batch)
+        if not jobs:
+            return done
+        for job_obj in jobs:
+            run(job_obj, worker)
+            done += 1
+
+
+# Основной цикл обработчика: берёт задачи пачками, а если очередь пуста - ждёт poll секунд
+def work(worker=None, poll=1.0, batch=10, should_stop=lambda: False):
+    worker = worker or worker_name()
+    while not should_stop():
+        close_old_connections()
+        jobs = claim(worker, batch)
+        for job_obj in jobs:
+            run(job_obj, worker)
+            if should_stop():
+                break
+        if not jobs:
+            time.sleep(poll)
@@ -0,0 +1,299 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+from collections import Counter
+from io import BytesIO
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from .bestsellers import add_sales
+from .models import (Category, ModelProduct, Product, ImagesProduct, Customer, FavoriteProduct, Cart, ProductCart,
+                     Delivery, Region, City, Order, ProductOrder)
+from .search import index_products
+from .storage import blob_storage, retain
+from .urls import urlpatterns
+
+# Пароль всех сгенерированных покупателей, под ним bench_urls входит на сайт
+LOADTEST_PASSWORD = 'loadtest-12345'
+
+WORDS = ['Диван', 'Кресло', 'Стол', 'Стул', 'Шкаф', 'Кровать', 'Комод', 'Тумба', 'Полка', 'Пуф']
+COLORS = [('Белый', '#ffffff'), ('Чёрный', '#000000'), ('Серый', '#808080'), ('Бежевый', '#f5f5dc'),
+          ('Коричневый', '#8b4513'), ('Зелёный', '#2e8b57')]
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# =====================  Генерация данных =============
+
+# Заполняет базу данными для нагрузочных тестов. Все объекты помечены префиксом в слаге или логине,
+# поэтому их можно удалить командой с --clear, не трогая настоящий каталог
+class LoadTestSeeder:
+    def __init__(self, prefix='lt', batch_size=1000, seed=None, log=print):
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.random = random.Random(seed)
+        self.log = log
+
+    def clear(self):
+        # Удаление по одному объекту через сигналы: освобождаются ссылки на фото и записи поиска
+        User.objects.filter(username__startswith=f'{self.prefix}-').delete()
+        Product.objects.filter(slug__startswith=f'{self.prefix}-').delete()
+        Category.objects.filter(slug__startswith=f'{self.prefix}-').order_by('-depth').delete()
+        ModelProduct.objects.filter(slug__startswith=f'{self.prefix}-').delete()
+        Region.objects.filter(name__startswith=f'{self.prefix}-').delete()
+
+    # Категории сохраняются через save(), чтобы посчитать путь в дереве, их немного
+    def make_categories(self, count):
+        roots = [Category.objects.create(title=f'Раздел {i}', slug=f'{self.prefix}-root-{i}')
+                 for i in range(max(1, count // 5))]
+        leaves = [Category.objects.create(title=f'Категория {i}', slug=f'{self.prefix}-cat-{i}',
+                                          parent=roots[i % len(roots)])
+                  for i in range(count)]
+        return leaves
+
+    def make_models(self, count):
+        ModelProduct.objects.bulk_create([ModelProduct(title=f'Модель {i}', slug=f'{self.prefix}-model-{i}')
+                                          for i in range(count)])
+        return list(ModelProduct.objects.filter(slug__startswith=f'{self.prefix}-model-').values_list('pk', flat=True))
+
+    # Несколько разных картинок на весь каталог: хранилище по содержимому хранит каждую один раз
+    def make_photos(self, count=len(COLORS)):
+        field = ImagesProduct._meta.get_field('image')
+        names = []
+        for i in range(count):
+            buffer = BytesIO()
+            Image.new('RGB', (800, 600), COLORS[i % len(COLORS)][1]).save(buffer, 'JPEG', quality=70)
+            names.append(blob_storage.save(field.generate_filename(None, f'{self.prefix}-{i}.jpg'),
+                                           ContentFile(buffer.getvalue())))
+        return names
+
+    def make_products(self, count, images_per_product, categories, models):
+        photos = self.make_photos()
+        product_ids = []
+        for start in range(0, count, self.batch_size):
+            batch = []
+            for i in range(start, min(start + self.batch_size, count)):
+                color_name, color_code = self.random.choice(COLORS)
+                word = self.random.choice(WORDS)
+                batch.append(Product(
+                    title=f'{word} {i}', slug=f'{self.prefix}-product-{i}', quantity=self.random.randint(100, 1000),
+                    description=f'{word} {color_name.lower()} для гостиной и спальни',
+                    price=self.random.randint(20, 2000) * 100, discount=self.random.choice([0, 0, 0, 5, 10, 20]),
+                    color_name=color_name, color_code=color_code, width=self.random.randint(40, 250),
+                    length=self.random.randint(40, 250), height=self.random.randint(40, 250),
+                    category=self.random.choice(categories), model_id=self.random.choice(models)))
+            with transaction.atomic():
+                Product.objects.bulk_create(batch)
+                ids = list(Product.objects.filter(slug__in=[p.slug for p in batch]).values_list('pk', flat=True))
+                images = [ImagesProduct(product_id=pk, image=self.random.choice(photos))
+                          for pk in ids for _ in range(images_per_product)]
+                ImagesProduct.objects.bulk_create(images)
+                retain(photo.image.name for photo in images)
+                index_products(Product.objects.filter(pk__in=ids))
+            product_ids.extend(ids)
+            self.log(f'Товаров: {len(product_ids)} из {count}')
+        return product_ids
+
+    # Покупатели с корзинами: пароль хэшируется один раз на всех
+    def make_users(self, count):
+        password = make_password(LOADTEST_PASSWORD)
+        for batch in chunks(range(count), self.batch_size):
+            with transaction.atomic():
+                User.objects.bulk_create([User(username=f'{self.prefix}-user-{i}@loft.ru', password=password)
+                                          for i in batch])
+                users = User.objects.filter(username__in=[f'{self.prefix}-user-{i}@loft.ru' for i in batch])
+                Customer.objects.bulk_create([Customer(user=user, phone='+70000000000') for user in users])
+                Cart.objects.bulk_create([Cart(customer_id=pk) for pk in
+                                          Customer.objects.filter(user__in=users).values_list('pk', flat=True)])
+        self.log(f'Покупателей: {count}')
+        return list(Cart.objects.filter(customer__user__username__startswith=f'{self.prefix}-user-')
+                    .values_list('pk', 'customer_id', 'customer__user_id'))
+
+    def make_cart_lines(self, carts, product_ids, lines_per_cart):
+        lines = [ProductCart(cart_id=cart_id, product_id=product_id, quantity=self.random.randint(1, 3))
+                 for cart_id, customer_id, user_id in carts
+                 for product_id in self.random.sample(product_ids, min(lines_per_cart, len(product_ids)))]
+        ProductCart.objects.bulk_create(lines, batch_size=self.batch_size)
+        self.log(f'Строк в корзинах: {len(lines)}')
+
+    def make_favorites(self, carts, product_ids, per_user):
+        favorites = [FavoriteProduct(user_id=user_id, product_id=product_id)
+                     for cart_id, customer_id, user_id in carts
+                     for product_id in self.random.sample(product_ids, min(per_user, len(product_ids)))]
+        FavoriteProduct.objects.bulk_create(favorites, batch_size=self.batch_size)
+        self.log(f'Избранных: {len(favorites)}')
+
+    # Заказы со сводкой и товарами, как их сохраняет save_order, но пачками
+    def make_orders(self, carts, product_ids, count, lines_per_order=3):
+        region = Region.objects.create(name=f'{self.prefix}-Регион')
+        city = City.objects.create(name=f'{self.prefix}-Город', region=region)
+        for batch in chunks(range(count), self.batch_size):
+            owners = [self.random.choice(carts) for _ in batch]
+            with transaction.atomic():
+                deliveries = Delivery.objects.bulk_create([
+                    Delivery(customer_id=customer_id, phone='+70000000000', region=region, city=city,
+                             street='Ленина', home='1') for cart_id, customer_id, user_id in owners])
+                picked = [self.random.sample(product_ids, min(lines_per_order, len(product_ids))) for _ in batch]
+                products = Product.objects.in_bulk({pk for ids in picked for pk in ids})
+                photos = dict(ImagesProduct.objects.filter(product_id__in=products).order_by('-pk')
+                              .values_list('product_id', 'image'))
+                orders = Order.objects.bulk_create([
+                    Order(customer_id=customer_id, cart_id=cart_id, delivery=delivery, completed=True,
+                          price=sum(products[pk].get_price() for pk in ids), line_count=len(ids),
+                          cover_photo=photos.get(ids[0], ''))
+                    for (cart_id, customer_id, user_id), delivery, ids in zip(owners, deliveries, picked)])
+                lines = [ProductOrder(order=order, name=products[pk].title, slug=products[pk].slug,
+                                      price=products[pk].get_price(), total_price=products[pk].get_price(),
+                                      quantity=1, photo=photos.get(pk, ''))
+                         for order, ids in zip(orders, picked) for pk in ids]
+                ProductOrder.objects.bulk_create(lines)
+                retain([order.cover_photo.name for order in orders] + [line.photo.name for line in lines])
+                add_sales(Counter(pk for ids in picked for pk in ids))
+        self.log(f'Заказов: {count}')
+
+    def run(self, categories, models, products, images, users, cart_lines, favorites, orders):
+        started = time.monotonic()
+        leaves = self.make_categories(categories)
+        product_ids = self.make_products(products, images, leaves, self.make_models(models))
+        carts = self.make_users(users)
+        if carts and product_ids:
+            self.make_cart_lines(carts, product_ids, cart_lines)
+            self.make_favorites(carts, product_ids, favorites)
+            self.make_orders(carts, product_ids, orders)
+        return time.monotonic() - started
+
+
+# =====================  Замер страниц =============
+
+# Запросы для каждого маршрута loft/urls.py: (метод, параметры адреса, нужен ли вход, данные).
+# Маршрут без описания здесь попадает в отчёт как пропущенный
+def route_specs(product, category, search_word):
+    return {
+        'main': ('get', {}, False, None),
+        'detail': ('get', {'slug': product.slug}, False, None),
+        'auth': ('get', {}, False, None),
+        'login': ('post', {}, False, {'username': 'nobody', 'password': 'wrong'}),
+        'logout': ('get', {}, False, None),  # анонимно, иначе клиент покупателя выйдет из аккаунта
+        'register': ('post', {}, False, {}),
+        'category': ('get', {'slug': category.slug}, False, None),
+        'sales': ('get', {}, False, None),
+        'search': ('get', {}, False, {'q': search_word}),
+        'action_fav': ('get', {'slug': product.slug}, True, None),
+        'favs': ('get', {}, True, None),
+        'action_cart': ('get', {'slug': product.slug, 'action': 'add'}, True, None),
+        'api_cart': ('post', {'slug': product.slug, 'action': 'add'}, True, {}),
+        'basket': ('get', {}, True, None),
+        'checkout': ('post', {}, True, {}),  # форма доставки открывается POST из корзины
+        'regions': ('get', {}, False, None),
+        'success': ('get', {}, True, None),
+        'profile': ('get', {}, True, None),
+        'orders': ('get', {}, True, None),
+        'contact': ('get', {}, False, None),
+    }
+
+
+# Маршруты, которые нельзя гонять в цикле: оплата обращается к внешнему API Stripe
+SKIPPED_ROUTES = {'payment': 'обращается к API Stripe, замеряйте с заглушкой fake_stripe отдельно'}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def measure(client, method, url, data, iterations, warmup):
+    for _ in range(warmup):
+        getattr(client, method)(url, data)
+    latencies, queries, sql_times, statuses = [], [], [], Counter()
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = getattr(client, method)(url, data)
+            latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(len(captured))
+        sql_times.append(sum(float(query['time']) for query in captured.captured_queries) * 1000)
+        statuses[response.status_code] += 1
+    return {
+        'url': url,
+        'method': method.upper(),
+        'status': {str(code): count for code, count in statuses.items()},
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p90': round(percentile(latencies, 90), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+            'mean': round(statistics.mean(latencies), 2),
+            'max': round(max(latencies), 2),
+        },
+        'queries': {'median': statistics.median_low(queries), 'max': max(queries)},
+        'sql_ms': {'mean': round(statistics.mean(sql_times), 2), 'max': round(max(sql_times), 2)},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Прогоняет все маршруты через тестовый клиент и возвращает отчёт. Страницы для вошедшего покупателя
+# открываются под user, остальные - анонимно, поэтому видно и работу условных GET-запросов
+def run_benchmark(user, iterations=50, warmup=3, only=None, host='localhost', log=print):
+    product = Product.objects.filter(images__isnull=False).order_by('pk').first() or Product.objects.order_by('pk').first()
+    category = Category.objects.filter(parent__isnull=True).order_by('pk').first()
+    if product is None or category is None:
+        raise ValueError('В базе нет товаров или категорий, заполните её командой seed_loadtest')
+    specs = route_specs(product, category, product.title.split()[0])
+
+    anonymous = Client(HTTP_HOST=host)
+    customer = Client(HTTP_HOST=host)
+    customer.force_login(user)
+
+    report = {'commit': git_commit(), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'database': connection.vendor, 'iterations': iterations, 'products': Product.objects.count(),
+              'routes': {}, 'skipped': {}}
+    for pattern in urlpatterns:
+        name = pattern.name
+        if only and name not in only:
+            continue
+        if name not in specs:
+            report['skipped'][name] = SKIPPED_ROUTES.get(name, 'нет описания запроса в route_specs')
+            continue
+        method, kwargs, auth, data = specs[name]
+        client = customer if auth else anonymous
+        report['routes'][name] = measure(client, method, reverse(name, kwargs=kwargs), data, iterations, warmup)
+        result = report['routes'][name]
+        log(f'{name:<12} p50 {result["latency_ms"]["p50"]:>8} мс  p95 {result["latency_ms"]["p95"]:>8} мс  '
+            f'запросов {result["queries"]["median"]:>4}  SQL {result["sql_ms"]["mean"]:>7} мс')
+    return report
+
+
+# Сравнение двух отчётов: {маршрут: (p50 было, p50 стало, запросов было, запросов стало)}
+def compare_reports(old, new):
+    changes = {}
+    for name, result in new['routes'].items():
+        before = old.get('routes', {}).get(name)
+        if before:
+            changes[name] = (before['latency_ms']['p50'], result['latency_ms']['p50'],
+                             before['queries']['median'], result['queries']['median'])
+    return changes
+
+
+def load_report(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
@@ -0,0 +1,50 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from loft.loadtest import compare_reports, load_report, run_benchmark
+
+
+# Замер всех страниц магазина: задержка по перцентилям, кол-во SQL-запросов и время SQL.
+# Отчёт в JSON можно сравнить с отчётом другого коммита через --compare
+class Command(BaseCommand):
+    help = 'Прогоняет маршруты loft/urls.py через тестовый клиент и пишет JSON-отчёт о скорости'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='bench.json', help='Файл отчёта, "-" - стандартный вывод')
+        parser.add_argument('--iterations', type=int, default=50, help='Запросов на маршрут')
+        parser.add_argument('--warmup', type=int, default=3, help='Прогревочных запросов на маршрут')
+        parser.add_argument('--route', action='append', help='Замерить только этот маршрут (можно несколько)')
+        parser.add_argument('--user', help='Логин покупателя для страниц, требующих входа')
+        parser.add_argument('--host', default='localhost', help='Значение заголовка Host')
+        parser.add_argument('--compare', help='Отчёт предыдущего замера для сравнения')
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(customer__cart__isnull=False)
+        user = users.filter(username=options['user']).first() if options['user'] else \
+            users.filter(username__endswith='-user-0@loft.ru').first() or users.order_by('pk').first()
+        if user is None:
+            raise CommandError('Нет покупателя с корзиной, заполните базу командой seed_loadtest или укажите --user')
+
+        progress = self.stderr if options['output'] == '-' else self.stdout
+        try:
+            report = run_benchmark(user, options['iterations'], options['warmup'], options['route'],
+                                   options['host'], log=progress.write)
+        except ValueError as error:
+            raise CommandError(error)
+
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(text)
+        else:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(text)
+            progress.write(self.style.SUCCESS(f'Отчёт сохранён в {options["output"]}'))
+
+        if options['compare']:
+            for name, (p50_before, p50_after, queries_before, queries_after) in compare_reports(
+                    load_report(options['compare']), report).items():
+                change = (p50_after - p50_before) / p50_before * 100 if p50_before else 0
+                progress.write(f'{name:<12} p50 {p50_before} → {p50_after} мс ({change:+.0f}%), '
+                               f'запросов {queries_before} → {queries_after}')
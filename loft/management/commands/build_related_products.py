@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from loft.related import build_related, RELATED_LIMIT
+
+
+# Полное построение индекса похожих товаров, запускается по расписанию
+class Command(BaseCommand):
+    help = 'Строит индекс похожих товаров по совместным покупкам, моделям и категориям'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=RELATED_LIMIT, help='Сколько соседей хранить на товар')
+
+    def handle(self, *args, **options):
+        total = build_related(limit=options['limit'])
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано товаров: {total}'))
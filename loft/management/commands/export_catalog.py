@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from loft.catalog import detect_format, export_rows, row_writer
+
+
+# Выгрузка каталога в формате, который принимает import_catalog
+class Command(BaseCommand):
+    help = 'Экспортирует товары с категориями, моделями и фото в CSV или JSONL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл выгрузки, "-" - стандартный вывод')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Формат файла, по умолчанию по расширению')
+        parser.add_argument('--images', help='Папка, куда скопировать фото товаров')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Сколько товаров читать за запрос')
+
+    def handle(self, *args, **options):
+        fmt = detect_format(options['path'], options['format'])
+        to_stdout = options['path'] == '-'
+        # При выгрузке в стандартный вывод прогресс пишется в stderr, чтобы не испортить файл
+        progress = self.stderr if to_stdout else self.stdout
+        if options['images']:
+            os.makedirs(options['images'], exist_ok=True)
+
+        file = sys.stdout if to_stdout else open(options['path'], 'w', encoding='utf-8', newline='')
+        started = time.monotonic()
+        total = 0
+        try:
+            write = row_writer(file, fmt)
+            for row in export_rows(options['chunk_size'], options['images']):
+                write(row)
+                total += 1
+                if total % options['chunk_size'] == 0:
+                    elapsed = time.monotonic() - started
+                    progress.write(f'Выгружено товаров: {total}, {total / max(elapsed, 0.001):.0f} в секунду')
+        finally:
+            if not to_stdout:
+                file.close()
+        progress.write(self.style.SUCCESS(f'Готово: {total} товаров за {time.monotonic() - started:.1f} с'))
@@ -0,0 +1,87 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from django.core.management.base import BaseCommand
+
+
+# Заглушка API Stripe для нагрузочных тестов оплаты без сети: создаёт сессии оплаты,
+# учитывает Idempotency-Key и может отвечать с задержкой или ошибкой 500
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    delay = 0
+    error_rate = 0
+    sessions = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        time.sleep(self.delay)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if self.path != '/v1/checkout/sessions':
+            return self.reply(404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown path'}})
+        if random.random() < self.error_rate:
+            return self.reply(500, {'error': {'type': 'api_error', 'message': 'Fake failure'}},
+                              {'Stripe-Should-Retry': 'true'})
+
+        params = parse_qs(body)
+        key = self.headers.get('Idempotency-Key') or uuid.uuid4().hex
+        with self.lock:
+            if key not in self.sessions:
+                session_id = f'cs_test_{uuid.uuid4().hex}'
+                self.sessions[key] = {
+                    'id': session_id,
+                    'object': 'checkout.session',
+                    'mode': params.get('mode', ['payment'])[0],
+                    # Оплата «проходит» сразу: ссылка ведёт на success_url магазина
+                    'url': params.get('success_url', [''])[0],
+                    'amount_total': int(params.get('line_items[0][price_data][unit_amount]', ['0'])[0]),
+                }
+            session = self.sessions[key]
+        self.reply(200, session, {'Idempotency-Key': key})
+
+    def reply(self, status, data, headers=None):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Request-Id', f'req_{uuid.uuid4().hex[:14]}')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # клиент не дождался ответа по таймауту
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host='127.0.0.1', port=0, delay=0, error_rate=0):
+    handler = type('Handler', (FakeStripeHandler,), {'delay': delay, 'error_rate': error_rate, 'sessions': {}})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальную заглушку API Stripe для нагрузочного тестирования оплаты'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--delay', type=float, default=0.3, help='Задержка ответа в секундах')
+        parser.add_argument('--error-rate', type=float, default=0, help='Доля ответов с ошибкой 500, от 0 до 1')
+
+    def handle(self, *args, **options):
+        server = make_server(options['host'], options['port'], options['delay'], options['error_rate'])
+        host, port = server.server_address[:2]
+        self.stdout.write(self.style.SUCCESS(
+            f'Заглушка Stripe: http://{host}:{port}, укажите STRIPE_API_BASE и любой STRIPE_SECRET_KEY'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from loft.images import delete_product_variants
+from loft.storage import collect_garbage, recount_refs
+
+
+# Удаление файлов хранилища, на которые больше не ссылается ни одна модель
+class Command(BaseCommand):
+    help = 'Удаляет из хранилища файлы без ссылок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=int, default=24,
+                            help='Не трогать файлы, загруженные за последние часы')
+        parser.add_argument('--recount', action='store_true', help='Сначала пересчитать ссылки по всем моделям')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет удалено')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            self.stdout.write(f'Пересчитаны ссылки файлов: {recount_refs()}')
+        # Варианты фото (миниатюры, WebP) названы по хэшу оригинала и удаляются вместе с ним
+        deleted, freed = collect_garbage(timedelta(hours=options['grace_hours']), options['dry_run'],
+                                         on_delete=delete_product_variants)
+        verb = 'Будет удалено' if options['dry_run'] else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(f'{verb} файлов: {deleted}, {freed / 1024 / 1024:.1f} МБ'))
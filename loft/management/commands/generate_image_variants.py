@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from loft.images import (executor, icon_variants_outdated, is_variant_of, make_product_image_variants,
+                         make_category_icon_variants, run_task)
+from loft.models import ImagesProduct, Category
+
+
+# Создание миниатюр и WebP для уже загруженных фото и иконок
+class Command(BaseCommand):
+    help = 'Создаёт миниатюры и WebP-версии фото товаров и иконок категорий'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Пересоздать варианты, даже если они уже есть')
+
+    def handle(self, *args, **options):
+        tasks = []
+        for photo in ImagesProduct.objects.only('pk', 'image', 'thumbnail').iterator():
+            if photo.image and (options['force'] or not is_variant_of(photo.thumbnail, photo.image)):
+                tasks.append((make_product_image_variants, photo.pk))
+        for category in Category.objects.only('pk', 'icon', 'icon_source'):
+            if category.icon and (options['force'] or icon_variants_outdated(category)):
+                tasks.append((make_category_icon_variants, category.pk))
+
+        futures = [executor.submit(run_task, func, pk) for func, pk in tasks]
+        for done, future in enumerate(futures, 1):
+            future.result()
+            if done % 100 == 0:
+                self.stdout.write(f'Обработано: {done} из {len(futures)}')
+        self.stdout.write(self.style.SUCCESS(f'Готово, обработано изображений: {len(futures)}'))
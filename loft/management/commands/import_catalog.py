@@ -0,0 +1,43 @@
+import sys
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from loft.catalog import CatalogError, CatalogImporter, detect_format, read_rows
+
+
+# Загрузка каталога поставщика из CSV или JSONL, товары обновляются по слагу
+class Command(BaseCommand):
+    help = 'Импортирует категории, модели, товары и фото из CSV или JSONL с обновлением по слагу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл каталога, "-" - стандартный ввод')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='Формат файла, по умолчанию по расширению')
+        parser.add_argument('--images', help='Папка с фото, пути в колонке images считаются от неё')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Сколько товаров сохранять за транзакцию')
+
+    def handle(self, *args, **options):
+        fmt = detect_format(options['path'], options['format'])
+        file = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8', newline='')
+        importer = CatalogImporter(options['images'])
+        rows = enumerate(read_rows(file, fmt), 1)
+        started = time.monotonic()
+        total = 0
+        try:
+            while True:
+                chunk = list(islice(rows, options['chunk_size']))
+                if not chunk:
+                    break
+                total += importer.import_chunk(chunk)
+                elapsed = time.monotonic() - started
+                self.stdout.write(f'Импортировано товаров: {total}, {total / max(elapsed, 0.001):.0f} в секунду')
+        except CatalogError as error:
+            # Уже сохранённые пачки остаются в базе, повторный запуск обновит их по слагу
+            raise CommandError(f'{error}. Сохранено товаров до ошибки: {total}')
+        finally:
+            if file is not sys.stdin:
+                file.close()
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово: {total} товаров за {time.monotonic() - started:.1f} с. '
+            f'Миниатюры новых фото создаст manage.py generate_image_variants'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from loft.search import rebuild_index
+
+
+# Полная перестройка поискового индекса товаров
+class Command(BaseCommand):
+    help = 'Перестраивает полнотекстовый индекс товаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Сколько товаров индексировать за раз')
+
+    def handle(self, *args, **options):
+        total = rebuild_index(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Проиндексировано товаров: {total}'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from loft.bestsellers import refresh_bestsellers, BESTSELLER_DAYS, BESTSELLER_LIMIT
+
+
+# Пересчёт хитов продаж за скользящее окно, запускается по расписанию
+class Command(BaseCommand):
+    help = 'Пересчитывает хиты продаж по заказам за последние дни'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=BESTSELLER_DAYS, help='Окно продаж в днях')
+        parser.add_argument('--limit', type=int, default=BESTSELLER_LIMIT, help='Сколько хитов хранить')
+
+    def handle(self, *args, **options):
+        total = refresh_bestsellers(options['days'], options['limit'])
+        self.stdout.write(self.style.SUCCESS(f'Хитов продаж: {total}'))
@@ -0,0 +1,51 @@
+import multiprocessing
+import signal
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from loft.jobs import run_pending, work, worker_name
+
+
+# Процесс-обработчик: по SIGTERM/SIGINT доделывает текущую задачу и завершается
+def run_process(poll, batch):
+    django.setup()
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *args: stopping.append(True))
+    work(worker_name(), poll, batch, should_stop=lambda: bool(stopping))
+
+
+class Command(BaseCommand):
+    help = 'Запускает обработчики фоновых задач из таблицы Job'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Сколько процессов-обработчиков запустить')
+        parser.add_argument('--poll', type=float, default=1.0, help='Пауза в секундах, когда очередь пуста')
+        parser.add_argument('--batch', type=int, default=10, help='Сколько задач забирать за раз')
+        parser.add_argument('--once', action='store_true', help='Выполнить готовые задачи и выйти')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            done = run_pending(batch=options['batch'])
+            self.stdout.write(self.style.SUCCESS(f'Выполнено задач: {done}'))
+            return
+
+        # Соединения с базой не должны переходить в дочерние процессы
+        connections.close_all()
+        processes = [multiprocessing.Process(target=run_process, args=(options['poll'], options['batch']))
+                     for _ in range(options['processes'])]
+        for process in processes:
+            process.start()
+        self.stdout.write(self.style.SUCCESS(f'Запущено обработчиков: {len(processes)}'))
+
+        # Родитель передаёт сигнал остановки обработчикам и ждёт их завершения
+        def stop(*args):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for process in processes:
+            process.join()
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from loft.loadtest import LoadTestSeeder, LOADTEST_PASSWORD
+from loft.models import Category
+
+
+# Наполнение базы синтетическими данными для нагрузочного тестирования и bench_urls
+class Command(BaseCommand):
+    help = 'Создаёт категории, модели, товары, фото, покупателей, корзины, избранное и заказы для нагрузочных тестов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--models', type=int, default=30)
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--images', type=int, default=2, help='Фото на товар')
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--cart-lines', type=int, default=3, help='Товаров в корзине покупателя')
+        parser.add_argument('--favorites', type=int, default=5, help='Избранных товаров на покупателя')
+        parser.add_argument('--orders', type=int, default=2000)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--prefix', default='lt', help='Префикс слагов и логинов сгенерированных объектов')
+        parser.add_argument('--seed', type=int, help='Зерно генератора для повторяемых данных')
+        parser.add_argument('--clear', action='store_true', help='Сначала удалить данные с тем же префиксом')
+
+    def handle(self, *args, **options):
+        seeder = LoadTestSeeder(options['prefix'], options['batch_size'], options['seed'], log=self.stdout.write)
+        if options['clear']:
+            seeder.clear()
+            self.stdout.write('Старые данные удалены')
+        elif Category.objects.filter(slug__startswith=f'{options["prefix"]}-').exists():
+            raise CommandError(f'Данные с префиксом {options["prefix"]} уже есть, укажите --clear или другой --prefix')
+        elapsed = seeder.run(options['categories'], options['models'], options['products'], options['images'],
+                             options['users'], options['cart_lines'], options['favorites'], options['orders'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово за {elapsed:.1f} с. Покупатели: {options["prefix"]}-user-N@loft.ru, пароль {LOADTEST_PASSWORD}. '
+            f'Похожие товары строит manage.py build_related_products'))
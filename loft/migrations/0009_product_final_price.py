@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:09
+
+import django.db.models.expressions
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0008_contact_alter_productorder_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='final_price',
+            field=models.GeneratedField(db_index=True, db_persist=True, expression=django.db.models.expressions.CombinedExpression(models.F('price'), '-', django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('price'), '*', models.F('discount')), '/', models.Value(100))), output_field=models.IntegerField(), verbose_name='Цена со скидкой'),
+        ),
+    ]
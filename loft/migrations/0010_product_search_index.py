@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# Таблица полнотекстового индекса зависит от базы данных: FTS5 в SQLite, tsvector в PostgreSQL.
+# SQL записан здесь, а не взят из loft.search, чтобы миграция не менялась вместе с кодом поиска
+CREATE_SQL = {
+    'sqlite': [
+        'CREATE VIRTUAL TABLE loft_product_fts USING fts5(title, body, tokenize="unicode61 remove_diacritics 2")',
+    ],
+    'postgresql': [
+        'CREATE TABLE loft_product_search (product_id bigint PRIMARY KEY, document tsvector NOT NULL)',
+        'CREATE INDEX loft_product_search_document ON loft_product_search USING GIN (document)',
+    ],
+}
+DROP_SQL = {
+    'sqlite': ['DROP TABLE IF EXISTS loft_product_fts'],
+    'postgresql': ['DROP TABLE IF EXISTS loft_product_search'],
+}
+
+
+def create_search_table(apps, schema_editor):
+    for sql in CREATE_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def drop_search_table(apps, schema_editor):
+    for sql in DROP_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0009_product_final_price'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
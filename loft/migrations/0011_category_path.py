@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:15
+
+from django.db import migrations, models
+
+
+# Заполняем пути существующих категорий сверху вниз по дереву
+def fill_category_paths(apps, schema_editor):
+    Category = apps.get_model('loft', 'Category')
+    level, parent_paths = list(Category.objects.filter(parent=None)), {None: ''}
+    while level:
+        for category in level:
+            category.path = f'{parent_paths[category.parent_id]}{category.pk:06d}/'
+            category.depth = category.path.count('/') - 1
+            parent_paths[category.pk] = category.path
+        Category.objects.bulk_update(level, ['path', 'depth'])
+        level = list(Category.objects.filter(parent_id__in=[category.pk for category in level]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0010_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Уровень вложенности'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255, verbose_name='Путь в дереве'),
+        ),
+        migrations.RunPython(fill_category_paths, migrations.RunPython.noop),
+    ]
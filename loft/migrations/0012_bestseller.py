@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0011_category_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Bestseller',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sold', models.IntegerField(db_index=True, default=0, verbose_name='Продано за период')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата пересчёта')),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='bestseller', to='loft.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Хит продаж',
+                'verbose_name_plural': 'Хиты продаж',
+            },
+        ),
+    ]
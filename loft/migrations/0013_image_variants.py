@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0012_bestseller'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='icon_thumbnail',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='icons/thumbs/', verbose_name='Иконка (миниатюра)'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='icon_webp',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='icons/webp/', verbose_name='Иконка (WebP)'),
+        ),
+        migrations.AddField(
+            model_name='imagesproduct',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='products/thumbs/', verbose_name='Миниатюра'),
+        ),
+        migrations.AddField(
+            model_name='imagesproduct',
+            name='thumbnail_webp',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='products/thumbs/', verbose_name='Миниатюра (WebP)'),
+        ),
+        migrations.AddField(
+            model_name='imagesproduct',
+            name='webp',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='products/webp/', verbose_name='Фото (WebP)'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:21
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+# Склеиваем повторяющиеся строки одного товара в корзине перед добавлением ограничения
+def merge_duplicate_lines(apps, schema_editor):
+    ProductCart = apps.get_model('loft', 'ProductCart')
+    duplicates = (ProductCart.objects.values('cart_id', 'product_id')
+                  .annotate(lines=Count('pk'), first=Min('pk'), total=Sum('quantity')).filter(lines__gt=1))
+    for row in duplicates:
+        ProductCart.objects.filter(pk=row['first']).update(quantity=row['total'])
+        ProductCart.objects.filter(cart_id=row['cart_id'], product_id=row['product_id']).exclude(
+            pk=row['first']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0013_image_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='productcart',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='loft_productcart_unique_product'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:30
+
+import django.utils.timezone
+import loft.storage
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+
+
+# В заказах хранился адрес фото (/media/products/...), теперь - имя файла в хранилище
+def strip_media_url(apps, schema_editor):
+    ProductOrder = apps.get_model('loft', 'ProductOrder')
+    ProductOrder.objects.filter(photo__startswith=settings.MEDIA_URL).update(
+        photo=Substr('photo', len(settings.MEDIA_URL) + 1))
+
+
+def add_media_url(apps, schema_editor):
+    ProductOrder = apps.get_model('loft', 'ProductOrder')
+    ProductOrder.objects.exclude(photo='').update(photo=Concat(Value(settings.MEDIA_URL), 'photo'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0016_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True, verbose_name='SHA-256')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Путь к файлу')),
+                ('size', models.BigIntegerField(default=0, verbose_name='Размер в байтах')),
+                ('refs', models.IntegerField(db_index=True, default=0, verbose_name='Кол-во ссылок')),
+                ('used_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Последняя загрузка')),
+            ],
+            options={
+                'verbose_name': 'Файл хранилища',
+                'verbose_name_plural': 'Файлы хранилища',
+            },
+        ),
+        migrations.AlterField(
+            model_name='contact',
+            name='photo',
+            field=models.FileField(blank=True, null=True, storage=loft.storage.ContentAddressedStorage(), upload_to='customers/', verbose_name='Файл, Фото'),
+        ),
+        migrations.AlterField(
+            model_name='imagesproduct',
+            name='image',
+            field=models.ImageField(storage=loft.storage.ContentAddressedStorage(), upload_to='products/', verbose_name='Фото товара'),
+        ),
+        migrations.AlterField(
+            model_name='productorder',
+            name='photo',
+            field=models.ImageField(blank=True, storage=loft.storage.ContentAddressedStorage(), upload_to='products/', verbose_name='Фото товара'),
+        ),
+        migrations.RunPython(strip_media_url, add_media_url),
+    ]
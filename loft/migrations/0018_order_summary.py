@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:32
+
+import loft.storage
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+# Заполняем сводку уже оформленных заказов и учитываем ссылки на фото обложек
+def fill_order_summary(apps, schema_editor):
+    Order = apps.get_model('loft', 'Order')
+    ProductOrder = apps.get_model('loft', 'ProductOrder')
+    StoredBlob = apps.get_model('loft', 'StoredBlob')
+
+    lines = ProductOrder.objects.filter(order=OuterRef('pk'))
+    Order.objects.update(
+        line_count=Coalesce(Subquery(lines.values('order').annotate(count=Count('pk')).values('count')[:1]), 0),
+        cover_photo=Coalesce(Subquery(lines.order_by('pk').values('photo')[:1]), Value('')),
+    )
+
+    covers = Counter(Order.objects.exclude(cover_photo='').values_list('cover_photo', flat=True))
+    for name, count in covers.items():
+        StoredBlob.objects.filter(name=name).update(refs=F('refs') + count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0017_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='cover_photo',
+            field=models.ImageField(blank=True, storage=loft.storage.ContentAddressedStorage(), upload_to='products/', verbose_name='Фото для списка'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='line_count',
+            field=models.IntegerField(default=0, verbose_name='Кол-во позиций'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', '-created_at', '-id'], name='loft_order_customer_created'),
+        ),
+        migrations.RunPython(fill_order_summary, migrations.RunPython.noop),
+    ]
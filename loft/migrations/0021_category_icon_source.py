@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:10
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+# Уже созданные варианты считаем сделанными из текущей иконки, чтобы первое сохранение их не сбросило
+def fill_icon_source(apps, schema_editor):
+    Category = apps.get_model('loft', 'Category')
+    Category.objects.exclude(icon_thumbnail='').exclude(icon_thumbnail=None).update(icon_source=F('icon'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loft', '0020_city_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='icon_source',
+            field=models.CharField(blank=True, default='', editable=False, max_length=100, verbose_name='Исходная иконка'),
+        ),
+        migrations.RunPython(fill_icon_source, migrations.RunPython.noop),
+    ]
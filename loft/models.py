@@ -1,16 +1,34 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import F, Prefetch, Sum, Value
+from django.db.models.functions import Concat, Substr
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 # Create your models here.
 from django.urls import reverse
 
+from .storage import blob_storage
+
 
 class Category(models.Model):
     title = models.CharField(max_length=150, verbose_name='Название')
     icon = models.ImageField(upload_to='icons/', verbose_name='Иконка', null=True, blank=True)
+    # Уменьшенные копии иконки, создаются в фоне после сохранения (кроме SVG)
+    icon_thumbnail = models.ImageField(upload_to='icons/thumbs/', null=True, blank=True, editable=False,
+                                       verbose_name='Иконка (миниатюра)')
+    icon_webp = models.ImageField(upload_to='icons/webp/', null=True, blank=True, editable=False,
+                                  verbose_name='Иконка (WebP)')
+    # Имя иконки, из которой сделаны варианты
+    icon_source = models.CharField(max_length=100, blank=True, default='', editable=False,
+                                   verbose_name='Исходная иконка')
     slug = models.SlugField(unique=True, verbose_name='Слаг категории')
     parent = models.ForeignKey('self', on_delete=models.CASCADE, verbose_name='Родитель',
                                related_name='subcategories', null=True, blank=True)
+    # Материализованный путь из pk всех предков и самой категории: 000001/000004/
+    path = models.CharField(max_length=255, default='', editable=False, db_index=True, verbose_name='Путь в дереве')
+    depth = models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Уровень вложенности')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
 
     def __str__(self):
         return self.title
@@ -18,7 +36,40 @@ class Category(models.Model):
     def get_absolute_url(self):
         return reverse('category', kwargs={'slug': self.slug})
 
+    # Иконку заменили или удалили - старые варианты сбрасываем, новые создаст фоновая задача.
+    # После сохранения пересчитываем путь, при смене родителя - одним UPDATE для всего поддерева
+    def save(self, *args, **kwargs):
+        if (self.icon.name or '') != self.icon_source:
+            self.icon_thumbnail = self.icon_webp = None
+        super().save(*args, **kwargs)
+        parent_path = self.parent.path if self.parent_id else ''
+        path = f'{parent_path}{self.pk:06d}/'
+        if path == self.path:
+            return
+
+        old_path, old_depth = self.path, self.depth
+        self.path, self.depth = path, path.count('/') - 1
+        Category.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+        if old_path:
+            Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                path=Concat(Value(path), Substr('path', len(old_path) + 1)),
+                depth=F('depth') + self.depth - old_depth, updated_at=timezone.now())
+
+    # Категория и все её потомки на любой глубине
+    def get_descendants(self, include_self=True):
+        categories = Category.objects.filter(path__startswith=self.path)
+        if not include_self:
+            categories = categories.exclude(pk=self.pk)
+        return categories
+
+    # Предки категории от корня, одним запросом по pk из пути
+    def get_ancestors(self):
+        ids = [int(pk) for pk in self.path.split('/')[:-2]]
+        return Category.objects.filter(pk__in=ids).order_by('depth')
+
     def get_icon(self):
+        if self.icon and self.icon_thumbnail:
+            return self.icon_thumbnail.url
         if self.icon:
             return self.icon.url
         else:
@@ -29,6 +80,15 @@ class Category(models.Model):
         verbose_name_plural = 'Категории'
 
 
+# QuerySet товаров с готовыми выборками для карточек каталога
+class ProductQuerySet(models.QuerySet):
+    # Все данные для карточки товара за фиксированное кол-во запросов:
+    # категория и модель через JOIN, фото одним дополнительным запросом
+    def for_cards(self):
+        images = ImagesProduct.objects.order_by('pk')
+        return self.select_related('category', 'model').prefetch_related(Prefetch('images', queryset=images))
+
+
 class Product(models.Model):
     title = models.CharField(max_length=250, verbose_name='Название')
     slug = models.SlugField(unique=True, verbose_name='Слаг товара')
@@ -41,6 +101,10 @@ class Product(models.Model):
     length = models.IntegerField(verbose_name='Глубина')
     height = models.IntegerField(verbose_name='Высота')
     discount = models.IntegerField(default=0, verbose_name='Скидка на товар')
+    # Цена со скидкой считается базой данных, по ней фильтруем и сортируем каталог
+    final_price = models.GeneratedField(expression=F('price') - F('price') * F('discount') / 100,
+                                        output_field=models.IntegerField(), db_persist=True, db_index=True,
+                                        verbose_name='Цена со скидкой')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата добавления')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
     category = models.ForeignKey(Category, on_delete=models.CASCADE, verbose_name='Категория',
@@ -48,12 +112,18 @@ class Product(models.Model):
     model = models.ForeignKey('ModelProduct', on_delete=models.CASCADE, verbose_name='Модель',
                               related_name='model_products')
 
+    objects = ProductQuerySet.as_manager()
+
     def __str__(self):
         return self.title
 
     def get_absolute_url(self):
         return reverse('detail', kwargs={'slug': self.slug})
 
+    # Первое фото товара как объект, с prefetch_related берётся из кэша
+    def first_image(self):
+        return self.images.first()
+
     def first_photo(self):
         if self.images:
             try:
@@ -88,12 +158,30 @@ class ModelProduct(models.Model):
 
 
 class ImagesProduct(models.Model):
-    image = models.ImageField(upload_to='products/', verbose_name='Фото товара')
+    image = models.ImageField(upload_to='products/', storage=blob_storage, verbose_name='Фото товара')
     product = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name='Товар', related_name='images')
+    # Варианты фото, создаются в фоне после загрузки
+    thumbnail = models.ImageField(upload_to='products/thumbs/', null=True, blank=True, editable=False,
+                                  verbose_name='Миниатюра')
+    thumbnail_webp = models.ImageField(upload_to='products/thumbs/', null=True, blank=True, editable=False,
+                                       verbose_name='Миниатюра (WebP)')
+    webp = models.ImageField(upload_to='products/webp/', null=True, blank=True, editable=False,
+                             verbose_name='Фото (WebP)')
 
     def __str__(self):
         return f'Фото товара {self.product.title}'
 
+    # Значения srcset: миниатюра для обычных экранов, полный размер для плотных
+    def get_srcset(self):
+        if self.thumbnail:
+            return f'{self.thumbnail.url} 1x, {self.image.url} 2x'
+        return ''
+
+    def get_webp_srcset(self):
+        if self.thumbnail_webp and self.webp:
+            return f'{self.thumbnail_webp.url} 1x, {self.webp.url} 2x'
+        return ''
+
     class Meta:
         verbose_name = 'Фото'
         verbose_name_plural = 'Фото товаров'
@@ -142,18 +230,21 @@ class Cart(models.Model):
         verbose_name = 'Корзину'
         verbose_name_plural = 'Корзины покупателей'
 
+    # Стоимость и кол-во товаров корзины одним агрегирующим запросом по цене со скидкой
+    @cached_property
+    def totals(self):
+        totals = self.productcart_set.aggregate(price=Sum(F('quantity') * F('product__final_price')),
+                                                quantity=Sum('quantity'))
+        return {'price': totals['price'] or 0, 'quantity': totals['quantity'] or 0}
+
     # Реализователь методы получения стоимости корзины и кол-во товаров в ней
     @property
     def cart_total_price(self):
-        products = self.productcart_set.all()  # Полуим список товаров корзины
-        price = sum([i.get_total_price for i in products])  # [14000, 7000]
-        return price
+        return self.totals['price']
 
     @property
     def cart_total_quantity(self):
-        products = self.productcart_set.all()  # Полуим список товаров корзины
-        quantity = sum([i.quantity for i in products])  # [2, 1]
-        return quantity
+        return self.totals['quantity']
 
 
 class ProductCart(models.Model):
@@ -177,6 +268,9 @@ class ProductCart(models.Model):
     class Meta:
         verbose_name = 'Товар в корзине'
         verbose_name_plural = 'Товары корзин'
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='loft_productcart_unique_product'),
+        ]
 
 
 class Delivery(models.Model):
@@ -213,6 +307,7 @@ class Region(models.Model):
 class City(models.Model):
     name = models.CharField(max_length=100, verbose_name='Название города')
     region = models.ForeignKey(Region, on_delete=models.CASCADE, verbose_name='Регион', related_name='cities')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
 
     def __str__(self):
         return self.name
@@ -230,6 +325,10 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата заказа')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата оплаты заказа')
     completed = models.BooleanField(default=False, verbose_name='Статус оплаты заказа')
+    # Сводка заказа на момент оформления, чтобы списки заказов не читали товары заказа
+    line_count = models.IntegerField(default=0, verbose_name='Кол-во позиций')
+    cover_photo = models.ImageField(upload_to='products/', storage=blob_storage, blank=True,
+                                    verbose_name='Фото для списка')
 
     def __str__(self):
         return f'Заказа № {self.pk} покупателя {self.customer.user.username}'
@@ -237,6 +336,9 @@ class Order(models.Model):
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы покупателей'
+        indexes = [
+            models.Index(fields=['customer', '-created_at', '-id'], name='loft_order_customer_created'),
+        ]
 
 
 class ProductOrder(models.Model):
@@ -244,7 +346,8 @@ class ProductOrder(models.Model):
     name = models.CharField(max_length=300, verbose_name='Название товара')
     slug = models.CharField(max_length=300, verbose_name='Слаг товара')
     price = models.IntegerField(default=0, verbose_name='Цена товара')
-    photo = models.ImageField(upload_to='products/', verbose_name='Фото товара')
+    # Ссылка на тот же файл, что и у фото товара, без копирования
+    photo = models.ImageField(upload_to='products/', storage=blob_storage, blank=True, verbose_name='Фото товара')
     quantity = models.IntegerField(default=0, verbose_name='Количество')
     total_price = models.IntegerField(default=0, verbose_name='На сумму в кол-ве')
 
@@ -256,12 +359,98 @@ class ProductOrder(models.Model):
         verbose_name_plural = 'Товары заказов'
 
 
+class Bestseller(models.Model):
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, verbose_name='Товар', related_name='bestseller')
+    sold = models.IntegerField(default=0, db_index=True, verbose_name='Продано за период')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата пересчёта')
+
+    def __str__(self):
+        return f'Хит продаж {self.product.title}: {self.sold} шт.'
+
+    class Meta:
+        verbose_name = 'Хит продаж'
+        verbose_name_plural = 'Хиты продаж'
+
+
+# Похожие товары: для каждого товара хранится не больше LOFT_RELATED_LIMIT соседей с весом
+class RelatedProduct(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name='Товар',
+                                related_name='related_links')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name='Похожий товар',
+                                related_name='related_to')
+    score = models.FloatField(default=0, verbose_name='Вес')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата пересчёта')
+
+    def __str__(self):
+        return f'{self.product.title} → {self.related.title}: {self.score}'
+
+    class Meta:
+        verbose_name = 'Похожий товар'
+        verbose_name_plural = 'Похожие товары'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'related'], name='loft_relatedproduct_unique_pair'),
+        ]
+        indexes = [
+            models.Index(fields=['product', '-score'], name='loft_related_product_score'),
+        ]
+
+
+
+# Файл в хранилище с адресацией по содержимому (loft/storage.py) и кол-во ссылок на него из моделей
+class StoredBlob(models.Model):
+    digest = models.CharField(max_length=64, unique=True, verbose_name='SHA-256')
+    name = models.CharField(max_length=255, unique=True, verbose_name='Путь к файлу')
+    size = models.BigIntegerField(default=0, verbose_name='Размер в байтах')
+    refs = models.IntegerField(default=0, db_index=True, verbose_name='Кол-во ссылок')
+    used_at = models.DateTimeField(default=timezone.now, verbose_name='Последняя загрузка')
+
+    def __str__(self):
+        return f'{self.name}: ссылок {self.refs}'
+
+    class Meta:
+        verbose_name = 'Файл хранилища'
+        verbose_name_plural = 'Файлы хранилища'
+
+
+# Фоновая задача: выполняется процессами manage.py runworker, см. loft/jobs.py
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUSES = (
+        (QUEUED, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (FAILED, 'Ошибка'),
+    )
+
+    name = models.CharField(max_length=100, verbose_name='Задача')
+    payload = models.JSONField(default=dict, blank=True, verbose_name='Аргументы')
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED, verbose_name='Статус')
+    run_at = models.DateTimeField(default=timezone.now, verbose_name='Запустить не раньше')
+    attempts = models.IntegerField(default=0, verbose_name='Попыток')
+    max_attempts = models.IntegerField(default=5, verbose_name='Максимум попыток')
+    locked_until = models.DateTimeField(null=True, blank=True, verbose_name='Занята до')
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name='Обработчик')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+
+    def __str__(self):
+        return f'{self.name} №{self.pk}: {self.get_status_display()}'
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='loft_job_status_run_at'),
+        ]
+
 
 class Contact(models.Model):
     full_name = models.CharField(max_length=100, verbose_name='ФИО')
     phone = models.CharField(max_length=50, verbose_name='Номер телефона')
     text = models.CharField(max_length=350, verbose_name='Запрос покупателя')
-    photo = models.FileField(upload_to='customers/', verbose_name='Файл, Фото', null=True, blank=True)
+    photo = models.FileField(upload_to='customers/', storage=blob_storage, verbose_name='Файл, Фото', null=True,
+                             blank=True)
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата запроса')
 
     def __str__(self):
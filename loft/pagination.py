@@ -0,0 +1,148 @@
+import base64
+import datetime
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import Http404
+
+
+# Ошибка разбора курсора из параметров запроса
+class InvalidCursor(Exception):
+    pass
+
+
+# Даты сохраняются с микросекундами, иначе курсор может пропустить товары с близким временем
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values, reverse=False):
+    data = json.dumps({'v': values, 'r': int(reverse)}, default=_json_default)
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return data['v'], bool(data['r'])
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+# Страница курсорной пагинации, повторяет нужную шаблонам часть django Page
+class CursorPage:
+    is_cursor = True
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+# Пагинация по ключу сортировки вместо OFFSET: каждая страница - один запрос с LIMIT,
+# независимо от её номера. Последнее поле сортировки должно быть уникальным (pk)
+class CursorPaginator:
+    def __init__(self, queryset, per_page, ordering, count_timeout=300):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+        self.count_timeout = count_timeout
+
+    @property
+    def fields(self):
+        return [field.lstrip('-') for field in self.ordering]
+
+    # Общее кол-во товаров берётся из кэша, COUNT(*) выполняется не чаще раза в count_timeout,
+    # при count_timeout=0 - каждый раз. У пустого queryset (.none()) нет SQL, для него ключ не строится
+    @property
+    def count(self):
+        if self.queryset.query.is_empty():
+            return 0
+        if self.count_timeout == 0:
+            return self.queryset.count()
+        key = 'loft:cursor-count:' + hashlib.md5(str(self.queryset.query).encode()).hexdigest()
+        return cache.get_or_set(key, self.queryset.count, self.count_timeout)
+
+    # Условие «строго после» значений курсора для составного ключа сортировки
+    def _after(self, values, reverse):
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            descending = field.startswith('-') != reverse
+            lookup = dict(zip(self.fields[:i], values))
+            lookup[f'{self.fields[i]}__{"lt" if descending else "gt"}'] = values[i]
+            condition |= Q(**lookup)
+        return condition
+
+    def _cursor(self, obj, reverse=False):
+        return encode_cursor([getattr(obj, field) for field in self.fields], reverse)
+
+    def page(self, cursor):
+        queryset = self.queryset.order_by(*self.ordering)
+        reverse = False
+        if cursor:
+            values, reverse = decode_cursor(cursor)
+            if len(values) != len(self.ordering):
+                raise InvalidCursor(cursor)
+            if reverse:
+                reversed_ordering = [field[1:] if field.startswith('-') else f'-{field}' for field in self.ordering]
+                queryset = self.queryset.order_by(*reversed_ordering)
+            queryset = queryset.filter(self._after(values, reverse))
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+        if not rows:
+            return CursorPage(rows, self)
+
+        # При движении назад лишняя строка означает, что есть ещё более ранние страницы
+        if reverse:
+            next_cursor = self._cursor(rows[-1])
+            previous_cursor = self._cursor(rows[0], reverse=True) if has_more else None
+        else:
+            next_cursor = self._cursor(rows[-1]) if has_more else None
+            previous_cursor = self._cursor(rows[0], reverse=True) if cursor else None
+        return CursorPage(rows, self, next_cursor, previous_cursor)
+
+
+# Миксин для ListView: курсорная пагинация включается параметром ?cursor=,
+# без него работает обычная постраничная пагинация. С cursor_only=True курсор используется всегда
+class CursorPaginationMixin:
+    cursor_param = 'cursor'
+    cursor_count_timeout = 300
+    cursor_only = False
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.cursor_only and self.cursor_param not in self.request.GET:
+            return super(CursorPaginationMixin, self).paginate_queryset(queryset, page_size)
+
+        ordering = [str(field) for field in queryset.query.order_by]
+        if not ordering or ordering[-1].lstrip('-') not in ('pk', 'id'):
+            ordering.append('-pk' if ordering and ordering[0].startswith('-') else 'pk')
+        paginator = CursorPaginator(queryset, page_size, ordering, self.cursor_count_timeout)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_param))
+        except InvalidCursor:
+            raise Http404('Неверный курсор')
+        return paginator, page, page.object_list, page.has_other_pages()
@@ -0,0 +1,64 @@
+import hashlib
+import uuid
+from functools import lru_cache
+
+import stripe
+from django.conf import settings
+from django.urls import reverse
+
+
+# Клиент Stripe с таймаутом и повторами из настроек. Клиент переиспользуется между запросами,
+# чтобы не открывать новое соединение на каждую оплату
+@lru_cache(maxsize=4)
+def _stripe_client(api_key, api_base, timeout, max_retries):
+    return stripe.StripeClient(api_key, base_addresses={'api': api_base}, max_network_retries=max_retries,
+                               http_client=stripe.RequestsClient(timeout=timeout))
+
+
+def get_stripe_client():
+    return _stripe_client(settings.STRIPE_SECRET_KEY, settings.STRIPE_API_BASE, settings.STRIPE_TIMEOUT,
+                          settings.STRIPE_MAX_RETRIES)
+
+
+# Попытка оформления: создаётся при открытии формы заказа и удаляется после успешной оплаты,
+# поэтому повторная покупка тех же товаров получает новый ключ идемпотентности
+CHECKOUT_NONCE_KEY = 'checkout_nonce'
+
+
+def get_checkout_nonce(session):
+    return session.setdefault(CHECKOUT_NONCE_KEY, uuid.uuid4().hex)
+
+
+def clear_checkout_nonce(session):
+    session.pop(CHECKOUT_NONCE_KEY, None)
+
+
+# Ключ идемпотентности зависит от попытки оформления, корзины и её содержимого: повторная отправка
+# той же корзины (двойной клик, повтор после таймаута) вернёт ту же сессию оплаты, а изменённая корзина
+# или новая попытка после оплаты - новую
+def idempotency_key(cart, products_cart, price, nonce):
+    lines = ','.join(f'{p_cart.product_id}:{p_cart.quantity}' for p_cart in products_cart)
+    digest = hashlib.sha256(f'{nonce}:{lines}:{price}'.encode()).hexdigest()[:32]
+    return f'checkout-{cart.pk}-{digest}'
+
+
+def checkout_session_params(request, products_cart, price):
+    return {
+        'payment_method_types': ['card'],
+        'line_items': [{
+            'price_data': {
+                'currency': 'rub',
+                'product_data': {'name': ',\n'.join(p_cart.product.title for p_cart in products_cart)},
+                'unit_amount': int(price) * 100
+            },
+            'quantity': 1
+        }],
+        'mode': 'payment',
+        'success_url': request.build_absolute_uri(reverse('success')),
+        'cancel_url': request.build_absolute_uri(reverse('checkout'))
+    }
+
+
+# Сессия оплаты Stripe, при повторах после сбоя сети отправляется тот же ключ идемпотентности
+def create_stripe_session(params, key):
+    return get_stripe_client().v1.checkout.sessions.create(params, options={'idempotency_key': key})
@@ -0,0 +1,117 @@
+from collections import Counter, defaultdict
+from itertools import permutations
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q
+
+from .caching import bump_version
+from .jobs import job
+from .models import Product, ProductOrder, RelatedProduct
+
+# Сколько похожих товаров храним и показываем для каждого товара
+RELATED_LIMIT = getattr(settings, 'LOFT_RELATED_LIMIT', 8)
+
+# Веса: каждый общий заказ, та же модель, та же категория, та же родительская категория.
+# Один совместный заказ весит больше, чем совпадение по всем остальным признакам
+CO_PURCHASE_WEIGHT = 4.0
+SAME_MODEL_WEIGHT = 2.0
+SAME_CATEGORY_WEIGHT = 1.0
+SAME_PARENT_WEIGHT = 0.5
+
+
+# Сколько раз товары покупали вместе: {слаг: Counter({слаг соседа: общих заказов})}.
+# В заказах хранится слаг, а не id, поэтому пары собираются по слагам. target_slugs=None - по всем заказам
+def co_purchases(target_slugs=None):
+    lines = ProductOrder.objects.all()
+    if target_slugs is not None:
+        lines = lines.filter(order_id__in=ProductOrder.objects.filter(slug__in=target_slugs).values('order_id'))
+
+    orders = defaultdict(set)
+    for order_id, slug in lines.values_list('order_id', 'slug').iterator():
+        orders[order_id].add(slug)
+    pairs = defaultdict(Counter)
+    for slugs in orders.values():
+        for a, b in permutations(slugs, 2):
+            if target_slugs is None or a in target_slugs:
+                pairs[a][b] += 1
+    return pairs
+
+
+# Товары, которые покупали вместе с товарами product_ids, вместе с ними самими
+def with_co_purchased(product_ids):
+    slugs = Product.objects.filter(pk__in=product_ids).values('slug')
+    orders = ProductOrder.objects.filter(slug__in=slugs).values('order_id')
+    partners = Product.objects.filter(slug__in=ProductOrder.objects.filter(order_id__in=orders).values('slug'))
+    return set(product_ids) | set(partners.values_list('pk', flat=True))
+
+
+# Пересчёт соседей для товаров product_ids (все товары, если None) одной транзакцией на запись.
+# Вместе с товарами заказа пересчитываются и их соседи по покупкам, чтобы их списки не отставали
+@job('related.build')
+def build_related(product_ids=None, limit=RELATED_LIMIT):
+    products = Product.objects.all()
+    if product_ids is not None:
+        product_ids = with_co_purchased(product_ids)
+        # Кандидаты - только товары из тех же моделей и категорий, что и пересчитываемые
+        targets = Product.objects.filter(pk__in=product_ids)
+        products = products.filter(Q(pk__in=product_ids) | Q(model__in=targets.values('model_id')) |
+                                   Q(category__in=targets.values('category_id')) |
+                                   Q(category__parent__in=targets.values('category__parent_id')))
+
+    rows = list(products.values_list('pk', 'slug', 'model_id', 'category_id', 'category__parent_id').order_by('-pk'))
+    slug_to_pk = {slug: pk for pk, slug, *_ in rows}
+    targets = set(product_ids) if product_ids is not None else set(slug_to_pk.values())
+
+    # Группы отсортированы от новых товаров к старым, из каждой берём не больше 2*limit кандидатов
+    by_model, by_category, by_parent = defaultdict(list), defaultdict(list), defaultdict(list)
+    for pk, slug, model_id, category_id, parent_id in rows:
+        by_model[model_id].append(pk)
+        by_category[category_id].append(pk)
+        if parent_id is not None:
+            by_parent[parent_id].append(pk)
+
+    pairs = co_purchases(None if product_ids is None else {slug for pk, slug, *_ in rows if pk in targets})
+    # Купленные вместе товары могут быть из других категорий - догружаем их id
+    missing = {slug for counter in pairs.values() for slug in counter} - slug_to_pk.keys()
+    if missing:
+        slug_to_pk.update(Product.objects.filter(slug__in=missing).values_list('slug', 'pk'))
+
+    links = []
+    for pk, slug, model_id, category_id, parent_id in rows:
+        if pk not in targets:
+            continue
+        scores = Counter()
+        for other, count in pairs[slug].items():
+            if other in slug_to_pk:
+                scores[slug_to_pk[other]] += count * CO_PURCHASE_WEIGHT
+        for group, weight in ((by_model[model_id], SAME_MODEL_WEIGHT),
+                              (by_category[category_id], SAME_CATEGORY_WEIGHT),
+                              (by_parent.get(parent_id, []), SAME_PARENT_WEIGHT)):
+            for related in group[:2 * limit + 1]:
+                scores[related] += weight
+        scores.pop(pk, None)
+        top = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))[:limit]
+        links.extend(RelatedProduct(product_id=pk, related_id=related, score=score) for related, score in top)
+
+    with transaction.atomic():
+        RelatedProduct.objects.filter(product_id__in=targets).delete()
+        RelatedProduct.objects.bulk_create(links, batch_size=1000)
+    bump_version('related')
+    return len(targets)
+
+
+# Состояние списка похожих товаров для ETag страницы товара: время пересчёта и кол-во соседей
+def related_state(slug):
+    state = RelatedProduct.objects.filter(product__slug=slug).aggregate(last=Max('updated_at'), count=Count('pk'))
+    return f'{state["last"]}:{state["count"]}'
+
+
+# Похожие товары для страницы товара одним запросом, пока индекс не построен - товары той же категории
+def get_related(product, limit=RELATED_LIMIT):
+    related = list(Product.objects.for_cards().filter(related_to__product=product)
+                   .order_by('-related_to__score', '-pk')[:limit])
+    if related:
+        return related
+    return Product.objects.for_cards().filter(
+        category__parent=product.category.parent_id).exclude(pk=product.pk).order_by('-pk')[:limit]
@@ -0,0 +1,260 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .models import Product
+
+
+# =====================  Русский стеммер (алгоритм Snowball) =============
+
+VOWELS = 'аеиоуыэюя'
+
+PERFECTIVE_GERUND = (('в', 'вши', 'вшись'), ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'))
+ADJECTIVE = ('ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'его', 'ого',
+             'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею')
+PARTICIPLE = (('ем', 'нн', 'вш', 'ющ', 'щ'), ('ивш', 'ывш', 'ующ'))
+REFLEXIVE = ('ся', 'сь')
+VERB = (('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно'),
+        ('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ило',
+         'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю'))
+NOUN = ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой', 'ий', 'й', 'иям',
+        'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я')
+SUPERLATIVE = ('ейше', 'ейш')
+DERIVATIONAL = ('ость', 'ост')
+
+
+# Позиция, с которой начинается область после первой гласной (RV) или первой пары гласная+согласная (R1, R2)
+def _region(word, start=0, after_vowel_only=False):
+    for i in range(start, len(word)):
+        if word[i] in VOWELS:
+            if after_vowel_only:
+                return i + 1
+            for j in range(i + 1, len(word)):
+                if word[j] not in VOWELS:
+                    return j + 1
+            break
+    return len(word)
+
+
+# Отрезает самое длинное окончание из групп, окончания первой группы должны идти после «а» или «я»
+def _cut(word, start, *groups):
+    ending, group = '', None
+    for index, endings in enumerate(groups):
+        for item in endings:
+            if len(item) > len(ending) and word.endswith(item) and len(word) - len(item) >= start:
+                ending, group = item, index
+    if not ending:
+        return None
+    if len(groups) > 1 and group == 0:
+        prev = len(word) - len(ending) - 1
+        if prev < start or word[prev] not in 'ая':
+            return None
+    return word[:-len(ending)]
+
+
+def stem(word):
+    word = word.lower().replace('ё', 'е')
+    rv = _region(word, after_vowel_only=True)
+    r1 = _region(word)
+    r2 = _region(word, r1)
+
+    # Шаг 1: деепричастие, либо возвратная частица и затем прилагательное, глагол или существительное
+    result = _cut(word, rv, *PERFECTIVE_GERUND)
+    if result is None:
+        word = _cut(word, rv, REFLEXIVE) or word
+        result = _cut(word, rv, ADJECTIVE)
+        if result is not None:
+            result = _cut(result, rv, *PARTICIPLE) or result
+        else:
+            result = _cut(word, rv, *VERB)
+            if result is None:
+                result = _cut(word, rv, NOUN)
+    word = result if result is not None else word
+
+    # Шаг 2-4: «и», словообразовательные окончания, превосходная степень, «нн» и «ь»
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+    word = _cut(word, r2, DERIVATIONAL) or word
+    word = _cut(word, rv, SUPERLATIVE) or word
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        word = word[:-1]
+    elif word.endswith('ь') and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+# Разбивает текст на слова и приводит их к основам
+def normalize(text):
+    words = re.findall(r'\w+', (text or '').lower().replace('ё', 'е'))
+    return [stem(word) for word in words]
+
+
+# =====================  Бэкенды поискового индекса =============
+
+# Бэкенд на SQLite FTS5: в индекс пишутся основы слов, ранжирование по BM25. Таблица создаётся миграцией 0010
+class SqliteSearchBackend:
+    table = 'loft_product_fts'
+
+    def _match(self, query):
+        words = [word.replace('"', '') for word in normalize(query)]
+        return ' '.join(f'"{word}"*' for word in words if word)
+
+    def index(self, products):
+        rows = [(product.pk, ' '.join(normalize(product.title)), ' '.join(normalize(document_body(product))))
+                for product in products]
+        with connection.cursor() as cursor:
+            self._delete(cursor, [row[0] for row in rows])
+            cursor.executemany(f'INSERT INTO {self.table} (rowid, title, body) VALUES (%s, %s, %s)', rows)
+
+    def remove(self, ids):
+        with connection.cursor() as cursor:
+            self._delete(cursor, ids)
+
+    def _delete(self, cursor, ids):
+        cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [(pk,) for pk in ids])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+
+    def count(self, query):
+        match = self._match(query)
+        if not match:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {self.table} WHERE {self.table} MATCH %s', [match])
+            return cursor.fetchone()[0]
+
+    def ranked_ids(self, query, offset, limit):
+        match = self._match(query)
+        if not match:
+            return []
+        with connection.cursor() as cursor:
+            # Совпадение в названии весит в 5 раз больше, чем в описании
+            cursor.execute(f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s '
+                           f'ORDER BY bm25({self.table}, 5.0, 1.0) LIMIT %s OFFSET %s', [match, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
+
+
+# Бэкенд на PostgreSQL: tsvector с русской конфигурацией и GIN-индексом. Таблица создаётся миграцией 0010
+class PostgresSearchBackend:
+    table = 'loft_product_search'
+
+    def _tsquery(self, query):
+        words = re.findall(r'\w+', (query or '').lower())
+        return ' & '.join(f'{word}:*' for word in words)
+
+    def index(self, products):
+        rows = [(product.pk, product.title, document_body(product)) for product in products]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (product_id, document) VALUES "
+                f"(%s, setweight(to_tsvector('russian', %s), 'A') || setweight(to_tsvector('russian', %s), 'B')) "
+                f"ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document", rows)
+
+    def remove(self, ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE product_id = ANY(%s)', [list(ids)])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {self.table}')
+
+    def count(self, query):
+        tsquery = self._tsquery(query)
+        if not tsquery:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {self.table} WHERE document @@ to_tsquery('russian', %s)",
+                           [tsquery])
+            return cursor.fetchone()[0]
+
+    def ranked_ids(self, query, offset, limit):
+        tsquery = self._tsquery(query)
+        if not tsquery:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT product_id FROM {self.table} WHERE document @@ to_tsquery('russian', %s) "
+                           f"ORDER BY ts_rank_cd(document, to_tsquery('russian', %s)) DESC, product_id "
+                           f"LIMIT %s OFFSET %s", [tsquery, tsquery, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
+
+
+BACKENDS = {
+    'sqlite': SqliteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+# Бэкенд из настройки LOFT_SEARCH_BACKEND, по умолчанию - по типу базы данных
+def get_backend_class(vendor=None):
+    path = getattr(settings, 'LOFT_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)
+    return BACKENDS[vendor or connection.vendor]
+
+
+def get_backend():
+    return get_backend_class()()
+
+
+# Текст для индекса помимо названия: описание, цвет, категория и модель
+def document_body(product):
+    return ' '.join([product.description, product.color_name, product.category.title, product.model.title])
+
+
+# =====================  Работа с индексом =============
+
+# Результаты поиска с ленивой подгрузкой страниц, подходят для Paginator
+class SearchResults:
+    def __init__(self, query, backend=None):
+        self.query = query
+        self.backend = backend or get_backend()
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.backend.count(self.query)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        offset = key.start or 0
+        ids = self.backend.ranked_ids(self.query, offset, key.stop - offset)
+        products = Product.objects.for_cards().in_bulk(ids)
+        return [products[pk] for pk in ids if pk in products]
+
+
+def search_products(query):
+    return SearchResults(query)
+
+
+# Переиндексация товаров пачками, товары берутся вместе с категорией и моделью
+def index_products(products, chunk_size=1000):
+    backend = get_backend()
+    products = products.select_related('category', 'model').order_by('pk')
+    total = 0
+    last_pk = 0
+    while True:
+        chunk = list(products.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        backend.index(chunk)
+        total += len(chunk)
+        last_pk = chunk[-1].pk
+    return total
+
+
+def remove_products(ids):
+    get_backend().remove(ids)
+
+
+def rebuild_index(chunk_size=1000):
+    get_backend().clear()
+    return index_products(Product.objects.all(), chunk_size)
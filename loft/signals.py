@@ -0,0 +1,125 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .caching import bump_version
+from .images import icon_variants_outdated, is_variant_of, make_product_image_variants, make_category_icon_variants
+from .models import Product, Category, ModelProduct, ImagesProduct, Region, City
+from .search import index_products, remove_products
+from .storage import blob_fields, blob_names, retain, release
+
+
+# Версия сбрасывается сразу и ещё раз после коммита, чтобы другие процессы
+# не закэшировали данные, прочитанные до окончания транзакции
+def invalidate(name):
+    bump_version(name)
+    transaction.on_commit(lambda: bump_version(name))
+
+
+# =====================  Поисковый индекс товаров =============
+
+@receiver(post_save, sender=Product)
+def index_saved_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: index_products(Product.objects.filter(pk=instance.pk)))
+
+
+@receiver(post_delete, sender=Product)
+def remove_deleted_product(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: remove_products([pk]))
+
+
+# Название категории и модели входит в индекс, поэтому переиндексируем их товары
+@receiver(post_save, sender=Category)
+def index_category_products(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        transaction.on_commit(lambda: index_products(Product.objects.filter(category=instance)))
+
+
+@receiver(post_save, sender=ModelProduct)
+def index_model_products(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        transaction.on_commit(lambda: index_products(Product.objects.filter(model=instance)))
+
+
+# =====================  Дерево категорий =============
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_tree(sender, **kwargs):
+    invalidate('category_tree')
+
+
+# =====================  Справочник регионов =============
+
+@receiver(post_save, sender=Region)
+@receiver(post_delete, sender=Region)
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def invalidate_regions(sender, **kwargs):
+    invalidate('regions')
+
+
+# =====================  Версии кэшированных карточек =============
+
+# Кэш карточек привязан к updated_at товара, поэтому фото и название категории обновляют его
+@receiver(post_save, sender=ImagesProduct)
+@receiver(post_delete, sender=ImagesProduct)
+def touch_image_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Category)
+def touch_category_products(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        Product.objects.filter(category=instance).update(updated_at=timezone.now())
+
+
+# =====================  Варианты изображений =============
+
+# Фото обрабатываются фоновыми задачами (manage.py runworker), сохранение в админке их не ждёт
+
+@receiver(post_save, sender=ImagesProduct)
+def make_image_variants(sender, instance, raw=False, **kwargs):
+    if not raw and instance.image and not is_variant_of(instance.thumbnail, instance.image):
+        make_product_image_variants.delay(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+def make_icon_variants(sender, instance, raw=False, **kwargs):
+    if not raw and icon_variants_outdated(instance):
+        make_category_icon_variants.delay(instance.pk)
+
+
+# =====================  Ссылки на файлы хранилища =============
+
+# При загрузке объекта запоминаем его файлы, при сохранении считаем разницу ссылок,
+# при удалении освобождаем все его файлы. Новый объект ещё ни на что не ссылается,
+# даже если имена файлов переданы в конструктор (Order.objects.create(cover_photo=...))
+def remember_blobs(sender, instance, **kwargs):
+    instance._blob_names = blob_names(instance, BLOB_FIELDS[sender])
+
+
+def update_blob_refs(sender, instance, created=False, **kwargs):
+    names = Counter(blob_names(instance, BLOB_FIELDS[sender]))
+    old = Counter() if created else Counter(getattr(instance, '_blob_names', []))
+    retain((names - old).elements())
+    release((old - names).elements())
+    instance._blob_names = list(names.elements())
+
+
+def release_blobs(sender, instance, **kwargs):
+    release(blob_names(instance, BLOB_FIELDS[sender]))
+
+
+BLOB_FIELDS = blob_fields()
+for model in BLOB_FIELDS:
+    post_init.connect(remember_blobs, sender=model)
+    post_save.connect(update_blob_refs, sender=model)
+    post_delete.connect(release_blobs, sender=model)
+
@@ -0,0 +1,75 @@
+// =======================================================================
+// Изменение корзины без перезагрузки страницы
+// =======================================================================
+// Ссылки с атрибутом data-cart-api отправляют POST на JSON-адрес корзины.
+// Если запрос не удался, браузер просто переходит по обычной ссылке
+let csrfToken = document.querySelector('meta[name="csrf-token"]').content;
+// Цены форматируются как фильтр intcomma на сервере (ru-ru): 1 800 с неразрывным пробелом.
+// Браузеры разделяют тысячи узким неразрывным пробелом, заменяем его на обычный неразрывный
+let ruNumber = new Intl.NumberFormat('ru-RU');
+let priceFormat = {
+    format: function (value) {
+        return ruNumber.format(value).replace(/\u202f/g, '\u00a0');
+    }
+};
+
+document.addEventListener('click', function (e) {
+    let link = e.target.closest('a[data-cart-api]');
+    if (!link) {
+        return;
+    }
+    e.preventDefault();
+
+    fetch(link.dataset.cartApi, {
+        method: 'POST',
+        headers: {'X-CSRFToken': csrfToken, 'X-Requested-With': 'XMLHttpRequest'},
+        credentials: 'same-origin'
+    })
+        .then(function (response) {
+            if (response.status === 401) {
+                return response.json().then(function (data) {
+                    window.location.href = data.login_url;
+                });
+            }
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.json().then(function (data) {
+                updateCart(link, data);
+            });
+        })
+        .catch(function () {
+            window.location.href = link.href;
+        });
+});
+
+function setText(selector, value, root = document) {
+    root.querySelectorAll(selector).forEach(function (element) {
+        element.textContent = value;
+    });
+}
+
+// Обновляем строку товара, итог корзины и значок в шапке
+function updateCart(link, data) {
+    let line = link.closest('[data-cart-line]');
+    if (line) {
+        if (data.quantity) {
+            setText('[data-line-quantity]', data.quantity, line);
+            setText('[data-line-total]', priceFormat.format(data.line_total), line);
+            setText('[data-line-old-total]', priceFormat.format(data.line_old_total), line);
+        } else {
+            line.remove();
+        }
+    }
+
+    setText('[data-cart-total]', priceFormat.format(data.cart_total));
+    setText('[data-cart-quantity]', data.cart_quantity);
+    document.querySelectorAll('.header__badge').forEach(function (badge) {
+        badge.hidden = !data.cart_quantity;
+    });
+
+    // Корзина опустела - перезагружаем страницу, чтобы убрать форму оформления заказа
+    if (line && !data.cart_quantity) {
+        window.location.reload();
+    }
+}
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import tempfile
+from collections import Counter
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db.models import F
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+
+# Размер куска при чтении загрузки: файл хэшируется на лету и целиком в память не попадает
+CHUNK_SIZE = 64 * 1024
+
+
+# Хранилище с адресацией по содержимому: имя файла - SHA-256 содержимого, поэтому одинаковые
+# фото лежат на диске один раз. Каждый файл учитывается в StoredBlob со счётчиком ссылок,
+# файлы без ссылок удаляет команда gc_media
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    prefix = 'blobs'
+
+    # Имя определяется содержимым в _save, суффиксы для уникальности не нужны
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        directory = self.path(self.prefix)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        digest, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    digest.update(chunk)
+                    temp.write(chunk)
+                    size += len(chunk)
+
+            hexdigest = digest.hexdigest()
+            name = f'{self.prefix}/{hexdigest[:2]}/{hexdigest[2:4]}/{hexdigest}{os.path.splitext(name)[1].lower()}'
+
+            # Повторная загрузка того же содержимого продлевает файлу жизнь, чтобы сборщик не удалил его до
+            # сохранения строки. Если содержимое уже лежит под другим расширением, используется прежнее имя,
+            # иначе файл с новым расширением не учитывался бы в StoredBlob и не удалялся сборщиком
+            StoredBlob = apps.get_model('loft', 'StoredBlob')
+            StoredBlob.objects.bulk_create([StoredBlob(digest=hexdigest, name=name, size=size, used_at=timezone.now())],
+                                           update_conflicts=True, unique_fields=['digest'], update_fields=['used_at'])
+            name = StoredBlob.objects.values_list('name', flat=True).get(digest=hexdigest)
+            path = self.path(name)
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+                if self.file_permissions_mode is not None:
+                    os.chmod(path, self.file_permissions_mode)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return name
+
+
+blob_storage = ContentAddressedStorage()
+
+
+# Поля моделей, которые хранят файлы в blob_storage: {модель: [поля]}
+def blob_fields():
+    fields = {}
+    for model in apps.get_app_config('loft').get_models():
+        names = [field.name for field in model._meta.get_fields()
+                 if getattr(field, 'storage', None) is blob_storage]
+        if names:
+            fields[model] = names
+    return fields
+
+
+# Изменение счётчиков ссылок: одно UPDATE на каждое встречающееся кол-во ссылок (обычно одно)
+def _change_refs(names, sign):
+    StoredBlob = apps.get_model('loft', 'StoredBlob')
+    by_count = {}
+    for name, count in Counter(name for name in names if name).items():
+        by_count.setdefault(count, []).append(name)
+    for count, group in by_count.items():
+        StoredBlob.objects.filter(name__in=group).update(refs=F('refs') + sign * count)
+
+
+# Имена файлов хранилища в полях объекта. Отложенные поля (only/defer) не загружаются
+def blob_names(instance, fields):
+    names = []
+    for field in fields:
+        value = instance.__dict__.get(field)
+        name = getattr(value, 'name', value)
+        if name:
+            names.append(name)
+    return names
+
+
+def retain(names):
+    _change_refs(names, 1)
+
+
+def release(names):
+    _change_refs(names, -1)
+
+
+# Полный пересчёт ссылок по всем полям с blob_storage, для восстановления после сбоев
+def recount_refs():
+    StoredBlob = apps.get_model('loft', 'StoredBlob')
+    refs = Counter()
+    for model, names in blob_fields().items():
+        for row in model.objects.values_list(*names).iterator():
+            refs.update(name for name in row if name)
+    blobs = list(StoredBlob.objects.only('pk', 'name', 'refs'))
+    for blob in blobs:
+        blob.refs = refs.get(blob.name, 0)
+    StoredBlob.objects.bulk_update(blobs, ['refs'], batch_size=1000)
+    return len(blobs)
+
+
+# Удаляет файлы без ссылок, которые не загружали дольше grace: свежий файл мог быть сохранён,
+# а строка со ссылкой на него ещё не записана. on_delete получает имя каждого удалённого файла.
+# Возвращает кол-во файлов и освобождённых байт
+def collect_garbage(grace, dry_run=False, on_delete=None):
+    StoredBlob = apps.get_model('loft', 'StoredBlob')
+    orphans = StoredBlob.objects.filter(refs__lte=0, used_at__lt=timezone.now() - grace)
+    deleted, freed = 0, 0
+    for blob in orphans.iterator():
+        # Строка удаляется условно: если на файл только что сослались, он остаётся
+        if not dry_run and not StoredBlob.objects.filter(pk=blob.pk, refs__lte=0).delete()[0]:
+            continue
+        if not dry_run:
+            blob_storage.delete(blob.name)
+            if on_delete:
+                on_delete(blob.name)
+        deleted += 1
+        freed += blob.size
+    return deleted, freed
@@ -1,12 +1,13 @@
-from loft.models import Category, FavoriteProduct
+from loft.caching import get_category_tree
 from django import template
 
 
 register = template.Library()
 
+# Корневые категории из кэшированного дерева, без запросов к базе
 @register.simple_tag()
 def get_categories():
-    categories = Category.objects.filter(parent=None)
+    categories = get_category_tree().roots
     return categories
 
 
@@ -14,13 +15,16 @@ def get_categories():
 @register.simple_tag(takes_context=True)
 def query_params(context, **kwargs):
     query = context['request'].GET.copy()
+    # При смене фильтров курсорная пагинация начинается с первой страницы
+    if 'cursor' in query and 'cursor' not in kwargs:
+        query['cursor'] = ''
     for key, value in kwargs.items():
         if value is not None and (key != 'page' or value != 1):
             query[key] = value
         elif key in query:
             del query[key]
 
-        lst = ['model', 'price_to', 'price_from']
+        lst = ['model', 'price_to', 'price_from', 'color']
         if key == 'cat':
             for i in lst:
                 try:
@@ -29,9 +33,3 @@ def query_params(context, **kwargs):
                     pass
     return query.urlencode()
 
-
-@register.simple_tag()
-def get_favorites(user):
-    favorites = FavoriteProduct.objects.filter(user=user)
-    products = [i.product for i in favorites]
-    return products
@@ -1,21 +1,1132 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock
+from unittest.mock import ANY
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .bestsellers import add_sales, refresh_bestsellers
+from .caching import get_category_tree, DATA_TTL, VERSION_TTL
+from .forms import ContactForm, CONTACT_MAX_UPLOAD
+from .images import make_product_image_variants
+from .jobs import job, claim, registry, run, run_pending
+from .loadtest import LoadTestSeeder, run_benchmark, compare_reports
+from .management.commands.fake_stripe import make_server
+from .models import (Category, ModelProduct, Product, ImagesProduct, FavoriteProduct, Customer, Cart, ProductCart,
+                     Bestseller, Region, City, Delivery, Order, ProductOrder, RelatedProduct, StoredBlob, Job)
+from .related import build_related, get_related, RELATED_LIMIT
+from .search import stem
+from .storage import collect_garbage, recount_refs, retain, release
+from .urls import urlpatterns
+from .utils import CartForAuthenticatedUser, OutOfStockError
 
 # Create your tests here.
 
-# Функция фильтрации товаров по запросам из парметров
-def filter_products(request, products):
-    cat = request.GET.get('cat')
-    price_from = request.GET.get('price_from')
-    price_to = request.GET.get('price_to')
-    model = request.GET.get('model')
-
-    if cat:
-        products = products.filter(category__slug=cat)
-    if price_from:
-        products = products.filter(price__gte=price_from)
-    if price_to:
-        products = products.filter(price__lte=price_to)
-    if model:
-        products = products.filter(model__slug=model)
-
-    return products
\ No newline at end of file
+
+# ===================== Бюджет SQL-запросов страниц каталога =====================
+
+# Максимальное кол-во запросов на страницу каталога вне зависимости от числа товаров
+# Значок корзины в шапке - один запрос на страницу, в корзине он берётся из уже посчитанных итогов
+CATALOG_QUERY_BUDGETS = {
+    'main': 6,
+    'detail': 10,
+    'category': 11,
+    'sales': 7,
+    'favs': 7,
+    'basket': 6,
+    'search': 8,
+    'orders': 7,
+}
+
+# Адреса без бюджета: формы, действия с корзиной и избранным, оплата. Новый адрес должен попасть
+# либо сюда, либо в CATALOG_QUERY_BUDGETS
+NON_CATALOG_URLS = {'auth', 'login', 'logout', 'register', 'action_fav', 'action_cart', 'api_cart', 'checkout',
+                    'regions', 'payment', 'success', 'profile', 'contact'}
+
+
+class CatalogQueryBudgetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='budget@loft.ru', password='pass-12345')
+        customer = Customer.objects.create(user=cls.user, phone='+70000000000')
+        cls.cart = Cart.objects.create(customer=customer)
+        cls.root = Category.objects.create(title='Гостиные', slug='living')
+        cls.subcat = Category.objects.create(title='Диваны', slug='sofas', parent=cls.root)
+        cls.model = ModelProduct.objects.create(title='Лофт', slug='loft')
+        cls.region = Region.objects.create(name='Краснодарский край')
+        cls.city = City.objects.create(name='Анапа', region=cls.region)
+
+    def setUp(self):
+        self.counter = 0
+
+    # Добавляет в каталог count товаров со скидкой, фото, в избранном, в корзине, в хитах продаж,
+    # в поисковом индексе и в истории заказов
+    def grow_catalog(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(count):
+                self.counter += 1
+                product = Product.objects.create(title=f'Диван {self.counter}', slug=f'sofa-{self.counter}',
+                                                 description='Диван', width=200, length=90, height=80,
+                                                 discount=10, category=self.subcat, model=self.model)
+                ImagesProduct.objects.create(product=product, image=f'products/sofa-{self.counter}-1.jpg')
+                ImagesProduct.objects.create(product=product, image=f'products/sofa-{self.counter}-2.jpg')
+                FavoriteProduct.objects.create(user=self.user, product=product)
+                ProductCart.objects.create(cart=self.cart, product=product, quantity=2)
+                Bestseller.objects.create(product=product, sold=self.counter)
+                delivery = Delivery.objects.create(customer=self.cart.customer, phone='+70000000000',
+                                                   region=self.region, city=self.city, street='Мира', home='1')
+                order = Order.objects.create(customer=self.cart.customer, cart=self.cart, delivery=delivery,
+                                             price=1800, line_count=1)
+                ProductOrder.objects.create(order=order, name=product.title, slug=product.slug, quantity=2)
+
+    def catalog_urls(self):
+        return {
+            'main': reverse('main'),
+            'detail': reverse('detail', kwargs={'slug': 'sofa-1'}),
+            'category': reverse('category', kwargs={'slug': self.root.slug}) + f'?cat={self.subcat.slug}',
+            'sales': reverse('sales'),
+            'favs': reverse('favs'),
+            'basket': reverse('basket'),
+            'search': reverse('search') + '?q=диваны',
+            'orders': reverse('orders'),
+        }
+
+    def count_queries(self):
+        counts = {}
+        for name, url in self.catalog_urls().items():
+            self.client.get(url)  # прогрев кэшей, считаем запросы в установившемся режиме
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            counts[name] = len(queries)
+        return counts
+
+    def test_catalog_urls_stay_within_budget(self):
+        self.client.force_login(self.user)
+        self.grow_catalog(6)  # больше одной страницы истории заказов
+        small = self.count_queries()
+        self.grow_catalog(10)
+        large = self.count_queries()
+
+        for name, budget in CATALOG_QUERY_BUDGETS.items():
+            self.assertLessEqual(large[name], budget, f'{name}: {large[name]} запросов')
+            self.assertEqual(small[name], large[name], f'{name}: запросы растут вместе с каталогом')
+
+    # Адреса берутся из loft.urls: новая страница каталога без бюджета не пройдёт
+    def test_every_catalog_url_has_budget(self):
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(names - NON_CATALOG_URLS, set(CATALOG_QUERY_BUDGETS))
+        self.assertEqual(set(self.catalog_urls()), set(CATALOG_QUERY_BUDGETS))
+
+    def test_cart_totals_use_discounted_price(self):
+        self.grow_catalog(3)
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.cart_total_price, 3 * 2 * 900)
+            self.assertEqual(cart.cart_total_quantity, 3 * 2)
+
+
+# ===================== Корзина =====================
+
+class CartApiTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='api@loft.ru', password='pass-12345')
+        Cart.objects.create(customer=Customer.objects.create(user=cls.user, phone='+70000000000'))
+        category = Category.objects.create(title='Кресла', slug='chairs')
+        model = ModelProduct.objects.create(title='Лофт', slug='loft')
+        Product.objects.create(title='Кресло', slug='chair', description='Кресло', price=1000, discount=10,
+                               quantity=2, width=1, length=1, height=1, category=category, model=model)
+
+    def post(self, action):
+        return self.client.post(reverse('api_cart', kwargs={'slug': 'chair', 'action': action}))
+
+    def test_add_delete_clear_return_totals(self):
+        self.client.force_login(self.user)
+        self.post('add')
+        data = self.post('add').json()
+        self.assertEqual(data, {'quantity': 2, 'line_total': 1800, 'line_old_total': 2000,
+                                'cart_total': 1800, 'cart_quantity': 2})
+        # Больше, чем есть на складе, добавить нельзя
+        self.assertEqual(self.post('add').json()['quantity'], 2)
+        self.assertEqual(self.post('delete').json()['cart_quantity'], 1)
+        self.assertEqual(self.post('clear').json(), {'quantity': 0, 'line_total': 0, 'line_old_total': 0,
+                                                     'cart_total': 0, 'cart_quantity': 0})
+
+    # Корзина берётся из сессии, каждое нажатие - один условный UPDATE или DELETE
+    def test_mutations_run_constant_queries(self):
+        request = SimpleNamespace(user=self.user, session={})
+        with self.assertNumQueries(4):  # корзина, UPDATE без строк, товар, INSERT
+            CartForAuthenticatedUser(request, 'chair', 'add')
+        line = ProductCart.objects.filter(cart__customer__user=self.user)
+        for action, queries, quantity in [('add', 1, 2), ('add', 3, 2), ('delete', 1, 1), ('delete', 2, None),
+                                          ('delete', 2, None), ('add', 3, 1), ('clear', 1, None)]:
+            with self.assertNumQueries(queries):
+                CartForAuthenticatedUser(request, 'chair', action)
+            self.assertEqual(line.values_list('quantity', flat=True).first(), quantity, action)
+
+    def test_anonymous_get_and_unknown_product(self):
+        response = self.post('add')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['login_url'], reverse('auth'))
+        self.client.force_login(self.user)
+        url = reverse('api_cart', kwargs={'slug': 'chair', 'action': 'add'})
+        self.assertEqual(self.client.get(url).status_code, 405)
+        url = reverse('api_cart', kwargs={'slug': 'nope', 'action': 'add'})
+        self.assertEqual(self.client.post(url).status_code, 404)
+
+
+# ===================== Оформление заказа =====================
+
+class CheckoutFinalizationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Кухни', slug='kitchens')
+        model = ModelProduct.objects.create(title='Сканди', slug='scandi')
+        cls.product = Product.objects.create(title='Стол', slug='table', description='Стол', quantity=1,
+                                             width=120, length=80, height=75, category=category, model=model)
+        cls.region = Region.objects.create(name='Краснодарский край')
+        cls.city = City.objects.create(name='Анапа', region=cls.region)
+
+    def make_buyer(self, email, quantity=1):
+        user = User.objects.create_user(username=email, password='pass-12345')
+        customer = Customer.objects.create(user=user, phone='+70000000000')
+        cart = Cart.objects.create(customer=customer)
+        ProductCart.objects.create(cart=cart, product=self.product, quantity=quantity)
+        delivery = Delivery.objects.create(customer=customer, phone='+70000000000', region=self.region,
+                                           city=self.city, street='Анапское шоссе', home='30')
+        return CartForAuthenticatedUser(SimpleNamespace(user=user)), delivery
+
+    def test_last_unit_is_sold_once(self):
+        first, first_delivery = self.make_buyer('first@loft.ru')
+        second, second_delivery = self.make_buyer('second@loft.ru')
+
+        order = first.save_order(first_delivery)
+        with self.assertRaises(OutOfStockError):
+            second.save_order(second_delivery)
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 0)
+        self.assertEqual(order.products.get().quantity, 1)
+        self.assertEqual(order.line_count, 1)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Bestseller.objects.get(product=self.product).sold, 1)
+        self.assertFalse(ProductCart.objects.filter(cart__customer__user__username='first@loft.ru').exists())
+        self.assertTrue(ProductCart.objects.filter(cart__customer__user__username='second@loft.ru').exists())
+
+    def pay(self, email):
+        buyer, delivery = self.make_buyer(email)
+        self.client.force_login(User.objects.get(username=email))
+        session = self.client.session
+        session[f'form_{session["_auth_user_id"]}'] = {'region': self.region.pk, 'city': self.city.pk, 'street': 'Мира',
+                                                        'home': '1', 'phone': '+70000000000'}
+        session.save()
+        return self.client.get(reverse('success'))
+
+    def test_success_page_creates_order(self):
+        self.assertContains(self.pay('paid@loft.ru'), 'Успешная оплата')
+        self.assertEqual(Order.objects.count(), 1)
+
+    # Строки корзины удалены между проверкой и оформлением: успех не показываем, доставку не храним
+    def test_vanished_cart_redirects_to_basket(self):
+        with mock.patch('loft.views.CartForAuthenticatedUser.save_order', return_value=None):
+            response = self.pay('late@loft.ru')
+        self.assertRedirects(response, reverse('basket'), fetch_redirect_response=False)
+        self.assertFalse(Delivery.objects.filter(street='Мира').exists())
+
+    # Между полными пересчётами в таблице хитов остаются только limit лучших товаров
+    def test_add_sales_keeps_top_limit(self):
+        other = Product.objects.create(title='Стул', slug='chair', description='Стул', width=1, length=1, height=1,
+                                       category=self.product.category, model=self.product.model)
+        add_sales({self.product.pk: 2}, limit=1)
+        add_sales({other.pk: 1}, limit=1)
+        self.assertEqual(list(Bestseller.objects.values_list('product_id', 'sold')), [(self.product.pk, 2)])
+        # Продажи вытесненного товара не копятся до полного пересчёта, он возвращается с новым итогом
+        add_sales({other.pk: 3}, limit=1)
+        self.assertEqual(list(Bestseller.objects.values_list('product_id', 'sold')), [(other.pk, 3)])
+
+    def test_refresh_bestsellers_uses_rolling_window(self):
+        buyer, delivery = self.make_buyer('buyer@loft.ru')
+        order = buyer.save_order(delivery)
+        ProductOrder.objects.create(order=order, name='Стол', slug='table', quantity=4)
+        Order.objects.filter(pk=order.pk).update(created_at=order.created_at - timedelta(days=40))
+
+        self.assertEqual(refresh_bestsellers(days=30), 0)
+        self.assertEqual(refresh_bestsellers(days=60), 1)
+        self.assertEqual(Bestseller.objects.get(product=self.product).sold, 5)
+
+
+# ===================== История заказов =====================
+
+class OrderHistoryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='history@loft.ru', password='pass-12345')
+        customer = Customer.objects.create(user=cls.user, phone='+70000000000')
+        cart = Cart.objects.create(customer=customer)
+        region = Region.objects.create(name='Краснодарский край')
+        city = City.objects.create(name='Ейск', region=region)
+        for i in range(12):
+            delivery = Delivery.objects.create(customer=customer, phone='+70000000000', region=region, city=city,
+                                               street='Мира', home=str(i))
+            order = Order.objects.create(customer=customer, cart=cart, delivery=delivery, price=100, line_count=2)
+            ProductOrder.objects.bulk_create([ProductOrder(order=order, name=f'Товар {i}-{j}', slug=f'item-{j}')
+                                              for j in range(2)])
+
+    def test_history_pages_use_constant_queries(self):
+        self.client.force_login(self.user)
+        url = reverse('orders')
+        self.client.get(url)  # прогрев кэша дерева категорий
+        # сессия, пользователь, покупатель, заказы страницы, их товары, значок корзины, кол-во заказов
+        with self.assertNumQueries(7):
+            first = self.client.get(url)
+        self.assertEqual([len(order.products.all()) for order in first.context['orders']], [2] * 5)
+        self.assertTrue(first.context['page_obj'].has_next())
+
+        seen = [order.pk for order in first.context['orders']]
+        response = first
+        while response.context['page_obj'].has_next():
+            response = self.client.get(url, {'cursor': response.context['page_obj'].next_cursor})
+            seen += [order.pk for order in response.context['orders']]
+        self.assertEqual(seen, list(Order.objects.order_by('-created_at', '-pk').values_list('pk', flat=True)))
+
+    def test_total_includes_new_order(self):
+        self.client.force_login(self.user)
+        url = reverse('orders')
+        self.assertEqual(self.client.get(url).context['page_obj'].paginator.count, 12)
+        order = Order.objects.first()
+        order.pk = None
+        order.delivery = Delivery.objects.create(customer=order.customer, phone='+70000000000', region=order.delivery.region,
+                                                 city=order.delivery.city, street='Мира', home='new')
+        order.save()
+        self.assertEqual(self.client.get(url).context['page_obj'].paginator.count, 13)
+
+    def test_profile_shows_summary_without_lines(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('profile'))
+        self.assertContains(response, 'позиций: 2')
+        self.assertFalse([query for query in queries if 'loft_productorder' in query['sql']])
+
+
+# ===================== Оплата =====================
+
+class AsyncPaymentTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='pay@loft.ru', password='pass-12345')
+        cart = Cart.objects.create(customer=Customer.objects.create(user=cls.user, phone='+70000000000'))
+        category = Category.objects.create(title='Шкафы', slug='wardrobes')
+        model = ModelProduct.objects.create(title='Лофт', slug='loft')
+        product = Product.objects.create(title='Шкаф', slug='wardrobe', description='Шкаф', width=1, length=1,
+                                         height=1, category=category, model=model)
+        cls.line = ProductCart.objects.create(cart=cart, product=product, quantity=1)
+
+    def stripe_server(self, delay=0):
+        server = make_server(delay=delay)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        host, port = server.server_address[:2]
+        return server, self.settings(STRIPE_API_BASE=f'http://{host}:{port}', STRIPE_SECRET_KEY='sk_test_fake',
+                                     STRIPE_TIMEOUT=0.5, STRIPE_MAX_RETRIES=0)
+
+    def test_same_cart_reuses_idempotent_session(self):
+        server, stripe_settings = self.stripe_server()
+        self.client.force_login(self.user)
+        with stripe_settings:
+            first = self.client.post(reverse('payment'))
+            second = self.client.post(reverse('payment'))
+            self.assertEqual(first.url, 'http://testserver' + reverse('success'))
+            self.assertEqual(len(server.RequestHandlerClass.sessions), 1)
+
+            self.line.quantity = 2
+            self.line.save()
+            self.client.post(reverse('payment'))
+            self.assertEqual(len(server.RequestHandlerClass.sessions), 2)
+        self.assertEqual(first.url, second.url)
+
+    # После оплаты те же товары в той же корзине - новая попытка, Stripe не должен вернуть оплаченную сессию
+    def test_repeat_purchase_gets_new_session(self):
+        server, stripe_settings = self.stripe_server()
+        region = Region.objects.create(name='Краснодарский край')
+        delivery = {'region': region.pk, 'city': City.objects.create(name='Сочи', region=region).pk,
+                    'street': 'Мира', 'home': '1', 'phone': '+70000000000'}
+        self.client.force_login(self.user)
+        with stripe_settings:
+            self.client.post(reverse('payment'), delivery)
+            self.assertContains(self.client.get(reverse('success')), 'Успешная оплата')
+            ProductCart.objects.create(cart=self.line.cart, product=self.line.product, quantity=1)
+            self.client.post(reverse('payment'), delivery)
+        self.assertEqual(len(server.RequestHandlerClass.sessions), 2)
+
+    def test_slow_stripe_times_out_back_to_basket(self):
+        server, stripe_settings = self.stripe_server(delay=1)
+        self.client.force_login(self.user)
+        with stripe_settings:
+            response = self.client.post(reverse('payment'))
+        self.assertRedirects(response, reverse('basket'), fetch_redirect_response=False)
+
+
+# ===================== Справочник регионов =====================
+
+class RegionDirectoryTest(TestCase):
+    def test_directory_is_cached_and_revalidated(self):
+        region = Region.objects.create(name='Краснодарский край')
+        sochi = City.objects.create(name='Сочи', region=region)
+        City.objects.create(name='Анапа', region=region)
+        url = reverse('regions')
+
+        response = self.client.get(url)
+        self.assertEqual(response.json(), {str(region.pk): [['Анапа', ANY], ['Сочи', ANY]]})
+        self.assertIn('max-age', response['Cache-Control'])
+        # Версия берётся из данных: тот же ETag после истечения кэша и в других процессах
+        cache.clear()
+        with self.assertNumQueries(1):
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        City.objects.create(name='Геленджик', region=region)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()[str(region.pk)]), 3)
+
+        sochi.name = 'Большой Сочи'
+        sochi.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+# ===================== Похожие товары =====================
+
+class RelatedProductsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        root = Category.objects.create(title='Гостиные', slug='living')
+        sofas = Category.objects.create(title='Диваны', slug='sofas', parent=root)
+        lamps = Category.objects.create(title='Светильники', slug='lamps')
+        model = ModelProduct.objects.create(title='Лофт', slug='loft')
+        for i in range(12):
+            Product.objects.create(title=f'Диван {i}', slug=f'sofa-{i}', description='Диван', width=1, length=1,
+                                   height=1, category=sofas, model=model)
+        Product.objects.create(title='Торшер', slug='lamp', description='Торшер', width=1, length=1, height=1,
+                               category=lamps, model=ModelProduct.objects.create(title='Арт', slug='art'))
+        region = Region.objects.create(name='Краснодарский край')
+        cls.city = City.objects.create(name='Сочи', region=region)
+
+    def buy(self, *slugs):
+        user = User.objects.create_user(username=f'{"-".join(slugs)}@loft.ru', password='pass-12345')
+        customer = Customer.objects.create(user=user, phone='+70000000000')
+        cart = Cart.objects.create(customer=customer)
+        for slug in slugs:
+            ProductCart.objects.create(cart=cart, product=Product.objects.get(slug=slug), quantity=1)
+        delivery = Delivery.objects.create(customer=customer, phone='+70000000000', region=self.city.region,
+                                           city=self.city, street='Курортный проспект', home='1')
+        CartForAuthenticatedUser(SimpleNamespace(user=user)).save_order(delivery)
+        run_pending()
+
+    def related_slugs(self, slug):
+        return [product.slug for product in get_related(Product.objects.get(slug=slug))]
+
+    def test_index_is_bounded_and_ranks_co_purchases_first(self):
+        build_related()
+        self.assertEqual(RelatedProduct.objects.filter(product__slug='sofa-0').count(), RELATED_LIMIT)
+        self.assertNotIn('lamp', self.related_slugs('sofa-0'))
+
+        # Заказ пересчитывает соседей своих товаров, включая товары из других категорий
+        self.buy('sofa-0', 'lamp')
+        self.assertEqual(self.related_slugs('sofa-0')[0], 'lamp')
+        self.assertEqual(self.related_slugs('lamp'), ['sofa-0'])
+
+    # Пересчёт после заказов даёт те же списки, что и полный пересчёт, в том числе у прежних соседей
+    def test_incremental_build_matches_full_build(self):
+        build_related()
+        self.buy('sofa-0', 'lamp')
+        self.buy('sofa-1', 'lamp')
+        self.buy('sofa-1', 'lamp', 'sofa-2')
+        links = set(RelatedProduct.objects.values_list('product_id', 'related_id', 'score'))
+        build_related()
+        self.assertEqual(links, set(RelatedProduct.objects.values_list('product_id', 'related_id', 'score')))
+
+    def test_detail_page_shows_bounded_list(self):
+        response = self.client.get(reverse('detail', kwargs={'slug': 'sofa-0'}))
+        self.assertEqual(len(response.context['same_products']), RELATED_LIMIT)
+        build_related()
+        product = Product.objects.get(slug='sofa-1')
+        with self.assertNumQueries(2):  # товары и их фото
+            self.assertEqual(len(get_related(product)), RELATED_LIMIT)
+
+
+# ===================== Поиск =====================
+
+class ProductSearchTest(TestCase):
+    def setUp(self):
+        category = Category.objects.create(title='Диваны', slug='sofas')
+        model = ModelProduct.objects.create(title='Честер', slug='chester')
+        with self.captureOnCommitCallbacks(execute=True):
+            for i, title in enumerate(['Угловой диван', 'Кровать двуспальная', 'Кресло']):
+                Product.objects.create(title=title, slug=f'item-{i}', description='Мягкая мебель для гостиной',
+                                       width=1, length=1, height=1, category=category, model=model)
+
+    def test_stemmer(self):
+        self.assertEqual(stem('угловые'), stem('угловой'))
+        self.assertEqual(stem('кровати'), stem('кроватью'))
+
+    def test_search_by_word_forms_with_ranking(self):
+        response = self.client.get(reverse('search'), {'q': 'угловые диваны'})
+        self.assertEqual([p.slug for p in response.context['products']], ['item-0'])
+
+        response = self.client.get(reverse('search'), {'q': 'мягкой'})
+        self.assertEqual(response.context['paginator'].count, 3)
+
+    def test_index_follows_deletes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.get(slug='item-1').delete()
+        response = self.client.get(reverse('search'), {'q': 'кровати'})
+        self.assertEqual(list(response.context['products']), [])
+
+
+# ===================== Фасеты фильтра =====================
+
+class CategoryFacetsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        root = Category.objects.create(title='Спальни', slug='bedrooms')
+        beds = Category.objects.create(title='Кровати', slug='beds', parent=root)
+        loft = ModelProduct.objects.create(title='Лофт', slug='loft')
+        nord = ModelProduct.objects.create(title='Норд', slug='nord')
+        for i, (price, model, color) in enumerate([(1000, loft, 'Белый'), (1200, loft, 'Чёрный'),
+                                                   (1700, nord, 'Белый')]):
+            Product.objects.create(title=f'Кровать {i}', slug=f'bed-{i}', description='', price=price,
+                                   color_name=color, width=1, length=1, height=1, category=beds, model=model)
+
+    def test_facet_counts_ignore_own_filter(self):
+        response = self.client.get(reverse('category', kwargs={'slug': 'bedrooms'}),
+                                   {'cat': 'beds', 'model': 'loft', 'price_from': 1100})
+        facets = response.context['facets']
+
+        self.assertEqual([(m['model__slug'], m['count']) for m in facets['models']], [('loft', 1), ('nord', 1)])
+        self.assertEqual([(c['color_name'], c['count']) for c in facets['colors']], [('Чёрный', 1)])
+        self.assertEqual([(p['price'], p['count']) for p in facets['price_from']], [(1000, 2)])
+        self.assertEqual([(p['price'], p['count']) for p in facets['price_to']], [(1000, 1), (1500, 2)])
+
+
+# ===================== Курсорная пагинация =====================
+
+class CursorPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Шкафы', slug='closets')
+        model = ModelProduct.objects.create(title='Купе', slug='coupe')
+        for i in range(7):
+            Product.objects.create(title=f'Шкаф {i}', slug=f'closet-{i}', description='', price=1000 + i % 3 * 100,
+                                   discount=5, width=1, length=1, height=1, category=category, model=model)
+
+    def walk(self, url, params):
+        slugs, pages, cursor = [], [], ''
+        while cursor is not None:
+            response = self.client.get(url, {**params, 'cursor': cursor})
+            page = response.context['page_obj']
+            pages.append(page)
+            slugs += [p.slug for p in page.object_list]
+            cursor = page.next_cursor
+        return slugs, pages
+
+    def test_cursor_pages_match_offset_order(self):
+        url = reverse('sales')
+        slugs, pages = self.walk(url, {})
+        self.assertEqual(slugs, [p.slug for p in Product.objects.order_by('-created_at', '-pk')])
+        self.assertEqual(pages[0].paginator.count, 7)
+
+        response = self.client.get(url, {'cursor': pages[-1].previous_cursor})
+        self.assertEqual(list(response.context['page_obj'].object_list), list(pages[-2].object_list))
+
+    def test_cursor_follows_active_sort_key(self):
+        closets = Category.objects.get(slug='closets')
+        closets.parent = Category.objects.create(title='Прихожие', slug='hall')
+        closets.save()
+        slugs, _ = self.walk(reverse('category', kwargs={'slug': 'hall'}), {'sort': '-price'})
+        self.assertEqual(slugs, [p.slug for p in Product.objects.order_by('-final_price', '-pk')])
+
+    def test_invalid_cursor_is_not_found(self):
+        self.assertEqual(self.client.get(reverse('sales'), {'cursor': 'broken'}).status_code, 404)
+
+    def test_unknown_subcategory_gives_empty_cursor_page(self):
+        response = self.client.get(reverse('category', kwargs={'slug': 'closets'}), {'cat': 'nope', 'cursor': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page_obj'].paginator.count, 0)
+
+
+# ===================== Кэш дерева категорий =====================
+
+class CategoryTreeCacheTest(TestCase):
+    def test_tree_is_cached_and_invalidated_on_save(self):
+        root = Category.objects.create(title='Офис', slug='office')
+        Category.objects.create(title='Кресла', slug='chairs', parent=root)
+        tree = get_category_tree()
+        self.assertEqual([child.slug for child in tree.by_slug['office'].children], ['chairs'])
+
+        with self.assertNumQueries(0):
+            get_category_tree()
+
+        root.title = 'Офисная мебель'
+        root.save()
+        self.assertEqual(get_category_tree().by_slug['office'].title, 'Офисная мебель')
+
+    # Изменение из другого процесса не сбрасывает версию в этом, но видно после истечения её ключа
+    def test_version_expires_for_other_processes(self):
+        Category.objects.create(title='Офис', slug='office')
+        get_category_tree()
+        Category.objects.filter(slug='office').update(title='Офисная мебель')
+        self.assertEqual(get_category_tree().by_slug['office'].title, 'Офис')
+
+        later = time.time() + VERSION_TTL + 1
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=later):
+            self.assertEqual(get_category_tree().by_slug['office'].title, 'Офисная мебель')
+
+    # Данные прежних версий не копятся в кэше: удаляются при сбросе версии и истекают сами
+    def test_old_versions_do_not_pile_up(self):
+        Category.objects.create(title='Офис', slug='office')
+        get_category_tree()
+        old_key = f'loft:category_tree:{cache.get("loft:version:category_tree")}'
+        self.assertIsNotNone(cache.get(old_key))
+        Category.objects.create(title='Дом', slug='home')
+        self.assertIsNone(cache.get(old_key))
+
+        get_category_tree()
+        key = f'loft:category_tree:{cache.get("loft:version:category_tree")}'
+        later = time.time() + DATA_TTL + 1
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=later):
+            self.assertIsNone(cache.get(key))
+
+    def test_paths_follow_parent_changes(self):
+        office = Category.objects.create(title='Офис', slug='office')
+        chairs = Category.objects.create(title='Кресла', slug='chairs', parent=office)
+        gaming = Category.objects.create(title='Игровые', slug='gaming', parent=chairs)
+        home = Category.objects.create(title='Дом', slug='home')
+
+        chairs.parent = home
+        chairs.save()
+        gaming.refresh_from_db()
+        self.assertEqual(gaming.path, f'{home.pk:06d}/{chairs.pk:06d}/{gaming.pk:06d}/')
+        self.assertEqual(gaming.depth, 2)
+        self.assertEqual(list(gaming.get_ancestors()), [home, chairs])
+        self.assertEqual(set(home.get_descendants()), {home, chairs, gaming})
+        self.assertEqual([node.slug for node in get_category_tree().ancestors(gaming.pk)], ['home', 'chairs', 'gaming'])
+
+
+# ===================== Кэш карточек товаров =====================
+
+class ProductCardCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        root = Category.objects.create(title='Детские', slug='kids')
+        cls.subcat = Category.objects.create(title='Столы', slug='desks', parent=root)
+        model = ModelProduct.objects.create(title='Школа', slug='school')
+        cls.product = Product.objects.create(title='Парта', slug='desk', description='', discount=10, width=1,
+                                             length=1, height=1, category=cls.subcat, model=model)
+        cls.user = User.objects.create_user(username='fav@loft.ru', password='pass-12345')
+        FavoriteProduct.objects.create(user=cls.user, product=cls.product)
+
+    def test_cached_card_is_shared_but_heart_is_per_user(self):
+        url = reverse('sales')
+        self.assertNotContains(self.client.get(url), 'products__item-heart active')
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get(url), 'products__item-heart active')
+
+    def test_card_follows_image_and_category_changes(self):
+        url = reverse('sales')
+        self.client.get(url)
+        ImagesProduct.objects.create(product=self.product, image='products/desk.jpg')
+        self.subcat.title = 'Парты'
+        self.subcat.save()
+
+        response = self.client.get(url)
+        self.assertContains(response, 'products/desk.jpg')
+        self.assertContains(response, 'Парты')
+
+
+# ===================== Фото товаров =====================
+
+class ImageVariantsTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+    def test_thumbnail_and_webp_variants(self):
+        buffer = BytesIO()
+        Image.new('RGBA', (1200, 800), (200, 100, 50, 255)).save(buffer, 'PNG')
+        category = Category.objects.create(title='Матрасы', slug='mattresses')
+        model = ModelProduct.objects.create(title='Сон', slug='sleep')
+        product = Product.objects.create(title='Матрас', slug='mattress', description='', width=1, length=1,
+                                         height=1, category=category, model=model)
+
+        with override_settings(MEDIA_ROOT=self.media_root):
+            photo = ImagesProduct.objects.create(product=product, image=SimpleUploadedFile('bed.png', buffer.getvalue()))
+            make_product_image_variants(photo.pk)
+            photo.refresh_from_db()
+
+            self.assertEqual(Image.open(photo.thumbnail.path).size, (400, 267))
+            self.assertEqual(Image.open(photo.webp.path).format, 'WEBP')
+            self.assertIn(photo.thumbnail_webp.url, photo.get_webp_srcset())
+
+    # Миниатюра иконки сбрасывается при удалении иконки, замене на SVG и на файл с похожим именем
+    def test_icon_variants_follow_icon_changes(self):
+        def png(color):
+            buffer = BytesIO()
+            Image.new('RGB', (200, 200), color).save(buffer, 'PNG')
+            return buffer.getvalue()
+
+        with override_settings(MEDIA_ROOT=self.media_root):
+            category = Category.objects.create(title='Диваны', slug='sofas',
+                                               icon=SimpleUploadedFile('sofa_big.png', png('red')))
+            run_pending()
+            category.refresh_from_db()
+            self.assertIn('icons/thumbs/sofa_big', category.get_icon())
+
+            category.icon = SimpleUploadedFile('sofa.png', png('blue'))
+            category.save()
+            self.assertEqual(category.get_icon(), category.icon.url)
+            run_pending()
+            category.refresh_from_db()
+            self.assertEqual(category.icon_source, category.icon.name)
+            self.assertEqual(Image.open(category.icon_thumbnail.path).getpixel((0, 0)), (0, 0, 255))
+
+            category.icon = SimpleUploadedFile('sofa.svg', b'<svg xmlns="http://www.w3.org/2000/svg"/>')
+            category.save()
+            run_pending()
+            category.refresh_from_db()
+            self.assertEqual(category.get_icon(), category.icon.url)
+
+            category.icon = None
+            category.save()
+            self.assertEqual(Category.objects.get(pk=category.pk).get_icon(), '-')
+
+    # Одинаковое фото в двух строках использует одни варианты, сборщик удаляет их вместе с оригиналом
+    def test_same_photo_shares_variants(self):
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), (10, 20, 30)).save(buffer, 'JPEG')
+        category = Category.objects.create(title='Шкафы', slug='wardrobes')
+        model = ModelProduct.objects.create(title='Гардероб', slug='wardrobe')
+        product = Product.objects.create(title='Шкаф', slug='wardrobe', description='', width=1, length=1,
+                                         height=1, category=category, model=model)
+
+        with override_settings(MEDIA_ROOT=self.media_root):
+            photos = [ImagesProduct.objects.create(product=product,
+                                                   image=SimpleUploadedFile(name, buffer.getvalue()))
+                      for name in ('front.jpg', 'copy.jpg')]
+            for photo in photos:
+                make_product_image_variants(photo.pk)
+                photo.refresh_from_db()
+            first, second = photos
+            self.assertEqual(first.thumbnail.name, second.thumbnail.name)
+            self.assertEqual(first.webp.name, second.webp.name)
+            self.assertEqual(len(os.listdir(os.path.dirname(first.thumbnail.path))), 2)  # jpg и webp
+
+            variants = [first.thumbnail.path, first.thumbnail_webp.path, first.webp.path]
+            product.delete()
+            call_command('gc_media', grace_hours=0, stdout=StringIO())
+            self.assertFalse(any(os.path.exists(path) for path in variants))
+
+
+# ===================== Фоновые задачи =====================
+
+class JobQueueTest(TestCase):
+    # Тестовая задача регистрируется только на время теста
+    def setUp(self):
+        self.calls = []
+
+        def flaky(value):
+            self.calls.append(value)
+            if value == 'fail':
+                raise ValueError(value)
+
+        self.flaky_job = job('tests.flaky', max_attempts=2)(flaky)
+        self.addCleanup(registry.pop, 'tests.flaky')
+
+    def test_jobs_run_once_and_are_removed(self):
+        self.flaky_job.delay('ok')
+        self.assertEqual(claim('other', limit=10)[0].attempts, 1)
+        self.assertEqual(claim('worker'), [])  # занята другим обработчиком
+        self.assertEqual(run_pending('worker'), 0)
+        Job.objects.update(locked_until=timezone.now() - timedelta(seconds=1))  # обработчик упал
+        self.assertEqual(run_pending('worker'), 1)
+        self.assertEqual(self.calls, ['ok'])
+        self.assertFalse(Job.objects.exists())
+
+    def test_failed_job_is_retried_with_backoff(self):
+        self.flaky_job.delay('fail')
+        with self.assertLogs('loft.jobs', 'WARNING'):
+            self.assertEqual(run_pending('worker'), 1)
+        retry = Job.objects.get()
+        self.assertEqual((retry.status, retry.attempts), (Job.QUEUED, 1))
+        self.assertGreater(retry.run_at, timezone.now())
+        self.assertIn('ValueError', retry.last_error)
+
+        with mock.patch('loft.jobs.timezone.now', return_value=retry.run_at + timedelta(seconds=1)), \
+                self.assertLogs('loft.jobs', 'WARNING'):
+            self.assertEqual(run_pending('worker'), 1)
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+        self.assertEqual(self.calls, ['fail', 'fail'])
+
+    def test_result_of_stolen_job_is_ignored(self):
+        self.flaky_job.delay('ok')
+        job_obj = claim('slow')[0]
+        Job.objects.update(locked_by='fast')
+        run(job_obj, 'slow')
+        self.assertTrue(Job.objects.filter(locked_by='fast').exists())
+
+    # Задача роняет обработчик на каждой попытке: после последней она помечается ошибкой, а не берётся снова
+    def test_abandoned_job_fails_after_max_attempts(self):
+        self.flaky_job.delay('ok')
+        for attempt in range(2):
+            self.assertEqual(len(claim(f'crashed-{attempt}')), 1)
+            Job.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(claim('worker'), [])
+        failed = Job.objects.get()
+        self.assertEqual((failed.status, failed.attempts), (Job.FAILED, 2))
+        self.assertEqual(self.calls, [])
+
+
+# ===================== Хранилище файлов =====================
+
+class ContentAddressedStorageTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        category = Category.objects.create(title='Тумбы', slug='stands')
+        model = ModelProduct.objects.create(title='Лофт', slug='loft')
+        self.products = [Product.objects.create(title=f'Тумба {i}', slug=f'stand-{i}', description='', width=1,
+                                                length=1, height=1, category=category, model=model)
+                         for i in range(2)]
+
+    def upload(self, product, content=b'same photo'):
+        return ImagesProduct.objects.create(product=product, image=SimpleUploadedFile('stand.jpg', content))
+
+    def test_same_content_is_stored_once_with_refs(self):
+        first, second = self.upload(self.products[0]), self.upload(self.products[1])
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(first.image.name.startswith('blobs/'))
+        blob = StoredBlob.objects.get()
+        self.assertEqual((blob.refs, blob.size), (2, len(b'same photo')))
+
+        # Замена фото переносит ссылку на новый файл
+        second.image = SimpleUploadedFile('other.jpg', b'other photo')
+        second.save()
+        self.assertEqual(dict(StoredBlob.objects.values_list('name', 'refs')),
+                         {first.image.name: 1, second.image.name: 1})
+
+    # То же содержимое с другим расширением не создаёт второй, неучтённый файл
+    def test_same_content_with_other_extension_reuses_blob(self):
+        first = self.upload(self.products[0])
+        second = ImagesProduct.objects.create(product=self.products[1],
+                                              image=SimpleUploadedFile('stand.png', b'same photo'))
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(StoredBlob.objects.get().refs, 2)
+        self.assertEqual(len(os.listdir(os.path.dirname(first.image.path))), 1)
+
+    def test_gc_keeps_files_referenced_by_orders(self):
+        photo = self.upload(self.products[0])
+        order_photo = ProductOrder(name='Тумба', slug='stand-0', photo=photo.image.name)
+        retain([order_photo.photo.name])
+        photo.delete()
+        self.assertEqual(collect_garbage(timedelta(0)), (0, 0))
+
+        release([order_photo.photo.name])
+        self.assertEqual(collect_garbage(timedelta(hours=1)), (0, 0))  # недавно загружен
+        self.assertEqual(collect_garbage(timedelta(0)), (1, len(b'same photo')))
+        self.assertFalse(os.path.exists(photo.image.path))
+        self.assertFalse(StoredBlob.objects.exists())
+
+    # Обложка заказа - ещё одна ссылка на фото товара: удаление заказа не должно удалить файл каталога
+    def test_deleted_order_keeps_product_photo(self):
+        photo = self.upload(self.products[0])
+        self.products[0].quantity = 1
+        self.products[0].save()
+        user = User.objects.create_user(username='buyer@loft.ru', password='pass-12345')
+        customer = Customer.objects.create(user=user, phone='+70000000000')
+        ProductCart.objects.create(cart=Cart.objects.create(customer=customer), product=self.products[0])
+        region = Region.objects.create(name='Краснодарский край')
+        delivery = Delivery.objects.create(customer=customer, phone='+70000000000', region=region,
+                                           city=City.objects.create(name='Анапа', region=region),
+                                           street='Анапское шоссе', home='30')
+
+        order = CartForAuthenticatedUser(SimpleNamespace(user=user)).save_order(delivery)
+        self.assertEqual(StoredBlob.objects.get().refs, 3)  # фото товара, обложка и строка заказа
+        order.delete()
+        call_command('gc_media', grace_hours=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(photo.image.path))
+        self.assertEqual(StoredBlob.objects.get().refs, 1)
+
+    def test_recount_repairs_refs(self):
+        self.upload(self.products[0])
+        self.upload(self.products[1])
+        StoredBlob.objects.update(refs=0)
+        recount_refs()
+        self.assertEqual(StoredBlob.objects.get().refs, 2)
+
+    def test_contact_upload_size_is_limited(self):
+        data = {'full_name': 'Иван', 'phone': '+70000000000', 'text': 'Вопрос'}
+        big = SimpleUploadedFile('big.jpg', b'0' * (CONTACT_MAX_UPLOAD + 1))
+        self.assertIn('photo', ContactForm(data, {'photo': big}).errors)
+        self.assertTrue(ContactForm(data, {'photo': SimpleUploadedFile('ok.jpg', b'0')}).is_valid())
+
+
+# ===================== Условные GET-запросы =====================
+
+class ConditionalGetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = Category.objects.create(title='Спальни', slug='bedrooms')
+        cls.subcat = Category.objects.create(title='Кровати', slug='beds', parent=cls.root)
+        model = ModelProduct.objects.create(title='Прованс', slug='provence')
+        cls.product = Product.objects.create(title='Кровать', slug='bed', description='Кровать', discount=5,
+                                             width=1, length=1, height=1, category=cls.subcat, model=model)
+
+    # Адрес и кол-во запросов для ответа 304: состояние товаров, категорий и похожих товаров
+    def urls(self):
+        return {
+            'detail': (reverse('detail', kwargs={'slug': 'bed'}), 4),
+            'category': (reverse('category', kwargs={'slug': 'bedrooms'}) + '?sort=price', 2),
+            'sales': (reverse('sales'), 2),
+        }
+
+    def test_unchanged_pages_are_not_modified(self):
+        for name, (url, queries) in self.urls().items():
+            etag = self.client.get(url)['ETag']
+            with self.assertNumQueries(queries):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, name)
+            self.assertEqual(response['ETag'], etag, name)
+            self.assertEqual(response['Cache-Control'], 'no-cache', name)
+
+    def test_changes_and_params_give_new_etag(self):
+        etags = {name: self.client.get(url)['ETag'] for name, (url, queries) in self.urls().items()}
+        other_page = self.client.get(reverse('category', kwargs={'slug': 'bedrooms'}) + '?sort=-price')
+        self.assertNotEqual(other_page['ETag'], etags['category'])
+
+        self.product.discount = 10
+        self.product.save()
+        for name, (url, queries) in self.urls().items():
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[name])
+            self.assertEqual(response.status_code, 200, name)
+
+    # Товар той же модели из другого раздела попадает на страницу в выбор цвета
+    def test_same_model_change_refreshes_detail(self):
+        other = Category.objects.create(title='Детская', slug='kids')
+        twin = Product.objects.create(title='Кровать детская', slug='kids-bed', description='', width=1, length=1,
+                                      height=1, category=other, model=self.product.model)
+        url = self.urls()['detail'][0]
+        etag = self.client.get(url)['ETag']
+        twin.color_code = '#000000'
+        twin.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    # ETag строится из данных: истёкший кэш или другой процесс дают тот же ETag
+    def test_etag_survives_cache_expiry(self):
+        etags = {name: self.client.get(url)['ETag'] for name, (url, queries) in self.urls().items()}
+        cache.clear()
+        for name, (url, queries) in self.urls().items():
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[name]).status_code, 304, name)
+
+    def test_category_and_related_changes_give_new_etag(self):
+        etags = {name: self.client.get(url)['ETag'] for name, (url, queries) in self.urls().items()}
+        self.root.title = 'Спальные комнаты'
+        self.root.save()
+        for name, (url, queries) in self.urls().items():
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[name]).status_code, 200, name)
+
+        Product.objects.create(title='Кровать двуспальная', slug='double-bed', description='', width=1, length=1,
+                               height=1, category=self.subcat, model=self.product.model)
+        url = self.urls()['detail'][0]
+        etag = self.client.get(url)['ETag']
+        build_related()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_authenticated_pages_are_always_rendered(self):
+        self.client.force_login(User.objects.create_user(username='etag@loft.ru', password='pass-12345'))
+        response = self.client.get(self.urls()['detail'][0])
+        self.assertFalse(response.has_header('ETag'))
+        self.assertEqual(set(response['Cache-Control'].split(', ')), {'no-cache', 'private'})
+
+
+# ===================== Админка =====================
+
+class AdminChangelistTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(username='admin@loft.ru', password='pass-12345')
+        cls.category = Category.objects.create(title='Столы', slug='tables')
+        cls.model = ModelProduct.objects.create(title='Скандинавия', slug='scandi')
+        cls.counter = 0
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def add_products(self, count, price=1000):
+        for _ in range(count):
+            AdminChangelistTest.counter += 1
+            product = Product.objects.create(title=f'Стол {self.counter}', slug=f'table-{self.counter}',
+                                             description='Стол', price=price, width=1, length=1, height=1,
+                                             category=self.category, model=self.model)
+            ImagesProduct.objects.create(product=product, image=f'blobs/aa/bb/{self.counter}.jpg')
+            user = User.objects.create_user(username=f'buyer{self.counter}@loft.ru', password='pass-12345')
+            customer = Customer.objects.create(user=user, phone='+70000000000')
+            cart = Cart.objects.create(customer=customer)
+            ProductCart.objects.create(cart=cart, product=product, quantity=1)
+
+    def count_queries(self, url):
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        urls = [reverse(f'admin:loft_{name}_changelist') for name in ('product', 'productcart', 'cart', 'customer')]
+        self.add_products(2)
+        before = {url: self.count_queries(url) for url in urls}
+        self.add_products(5)
+        for url in urls:
+            self.assertEqual(self.count_queries(url), before[url], url)
+
+    def test_price_bucket_filter(self):
+        self.add_products(1, price=5000)
+        self.add_products(1, price=50000)
+        url = reverse('admin:loft_product_changelist')
+        response = self.client.get(url, {'price_bucket': '30-60'})
+        self.assertEqual([p.price for p in response.context['cl'].result_list], [50000])
+
+    def test_bulk_actions_run_single_update(self):
+        self.add_products(3)
+        Product.objects.filter(pk=Product.objects.order_by('pk').first().pk).update(quantity=2)
+        url = reverse('admin:loft_product_changelist')
+        ids = [str(pk) for pk in Product.objects.values_list('pk', flat=True)]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url, {'action': 'set_discount', 'value': 15, '_selected_action': ids, 'index': 0})
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE "loft_product"')]), 1)
+        self.assertEqual(set(Product.objects.values_list('discount', flat=True)), {15})
+
+        self.client.post(url, {'action': 'adjust_stock', 'value': -5, '_selected_action': ids, 'index': 0})
+        self.assertEqual(sorted(Product.objects.values_list('quantity', flat=True)), [0, 5, 5])
+
+        self.client.post(url, {'action': 'set_discount', 'value': 150, '_selected_action': ids, 'index': 0})
+        self.assertEqual(set(Product.objects.values_list('discount', flat=True)), {15})
+
+
+# ===================== Импорт и экспорт каталога =====================
+
+class CatalogImportExportTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.enterContext(override_settings(MEDIA_ROOT=os.path.join(self.dir, 'media')))
+        self.images = os.path.join(self.dir, 'images')
+        os.makedirs(self.images)
+        with open(os.path.join(self.images, 'chair.jpg'), 'wb') as file:
+            file.write(b'chair photo')
+
+    def write_feed(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        return path
+
+    def import_feed(self, path, **options):
+        call_command('import_catalog', path, images=self.images, chunk_size=2, stdout=StringIO(), **options)
+
+    def test_csv_import_upserts_by_slug(self):
+        header = 'slug,title,quantity,price,discount,width,length,height,category,category_title,category_parent,model,images\n'
+        path = self.write_feed('feed.csv', header + ''.join(
+            f'chair-{i},Стул {i},5,{1000 * i},0,1,1,1,chairs,Стулья,kitchen,nordic,chair.jpg\n' for i in range(1, 4)))
+        self.import_feed(path)
+
+        self.assertEqual(Product.objects.count(), 3)
+        chairs = Category.objects.get(slug='chairs')
+        self.assertEqual(chairs.parent.slug, 'kitchen')
+        self.assertEqual(chairs.path, f'{chairs.parent.pk:06d}/{chairs.pk:06d}/')
+        photo = ImagesProduct.objects.get(product__slug='chair-1')
+        self.assertTrue(photo.image.name.startswith('blobs/'))
+        self.assertEqual(StoredBlob.objects.get().refs, 3)
+
+        # Повторный импорт обновляет товары по слагу без дублей фото
+        self.import_feed(self.write_feed('update.csv', header + 'chair-1,Стул новый,2,900,10,1,1,1,chairs,,,nordic,chair.jpg\n'))
+        product = Product.objects.get(slug='chair-1')
+        self.assertEqual((product.title, product.final_price, product.images.count()), ('Стул новый', 810, 1))
+        self.assertEqual(Product.objects.count(), 3)
+
+    def test_export_and_import_round_trip(self):
+        path = self.write_feed('feed.jsonl', json.dumps({
+            'slug': 'table', 'title': 'Стол', 'description': 'Дубовый стол', 'quantity': 3, 'price': 5000,
+            'discount': 0, 'width': 1, 'length': 2, 'height': 3, 'category': 'tables', 'category_title': 'Столы',
+            'model': 'oak', 'model_title': 'Дуб', 'images': ['chair.jpg']}, ensure_ascii=False) + '\n')
+        self.import_feed(path)
+        response = self.client.get(reverse('search'), {'q': 'дубовые'})
+        self.assertEqual([p.slug for p in response.context['products']], ['table'])
+
+        export = os.path.join(self.dir, 'export.jsonl')
+        exported_images = os.path.join(self.dir, 'exported')
+        call_command('export_catalog', export, images=exported_images, stdout=StringIO())
+        with open(export, encoding='utf-8') as file:
+            row = json.loads(file.readline())
+        self.assertEqual((row['model_title'], row['category'], row['length']), ('Дуб', 'tables', 2))
+        self.assertTrue(os.path.exists(os.path.join(exported_images, row['images'][0])))
+
+        Product.objects.all().delete()
+        call_command('import_catalog', export, images=exported_images, stdout=StringIO())
+        self.assertEqual(Product.objects.get().images.get().image.name, ImagesProduct.objects.get().image.name)
+
+    def test_bad_row_reports_line(self):
+        path = self.write_feed('bad.csv', 'slug,title,quantity,price,discount,width,length,height,category,model\n'
+                                          'sofa,Диван,1,abc,0,1,1,1,sofas,loft\n')
+        with self.assertRaisesMessage(CommandError, 'Строка 1'):
+            self.import_feed(path)
+        self.assertFalse(Product.objects.exists())
+
+
+# ===================== Нагрузочные данные и замеры =====================
+
+class LoadTestTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        LoadTestSeeder(batch_size=7, seed=1, log=lambda message: None).run(
+            categories=3, models=2, products=20, images=2, users=4, cart_lines=2, favorites=3, orders=5)
+
+    def test_seed_creates_consistent_data(self):
+        self.assertEqual(Product.objects.count(), 20)
+        self.assertEqual(ImagesProduct.objects.count(), 40)
+        self.assertEqual(ProductCart.objects.count(), 8)
+        self.assertEqual(Order.objects.filter(line_count=3).count(), 5)
+        self.assertEqual(sum(StoredBlob.objects.values_list('refs', flat=True)),
+                         40 + Order.objects.count() + ProductOrder.objects.count())
+        self.assertTrue(all(c.path.endswith(f'{c.pk:06d}/') for c in Category.objects.filter(parent__isnull=False)))
+
+    def test_benchmark_covers_every_route(self):
+        user = User.objects.filter(username__startswith='lt-user-').first()
+        report = run_benchmark(user, iterations=2, warmup=1, log=lambda message: None)
+        self.assertEqual(set(report['routes']) | set(report['skipped']), {p.name for p in urlpatterns})
+        self.assertEqual(list(report['skipped']), ['payment'])
+        for name, result in report['routes'].items():
+            self.assertTrue(all(code < 500 for code in map(int, result['status'])), name)
+            self.assertGreaterEqual(result['latency_ms']['p95'], result['latency_ms']['p50'])
+        self.assertEqual(compare_reports(report, report)['detail'][2], report['routes']['detail']['queries']['median'])
@@ -10,11 +10,14 @@ urlpatterns = [
     path('register/', register_user_view, name='register'),
     path('category/<slug:slug>/', ProductByCategory.as_view(), name='category'),
     path('sales/', SalesProducts.as_view(), name='sales'),
+    path('search/', SearchProducts.as_view(), name='search'),
     path('action_favorite/<slug:slug>/', save_favorite_product, name='action_fav'),
     path('favorites/', FavoriteList.as_view(), name='favs'),
     path('action_cart/<slug:slug>/<str:action>/', add_or_delete_view, name='action_cart'),
+    path('api/cart/<slug:slug>/<str:action>/', cart_api_view, name='api_cart'),
     path('basket/', my_cart_view, name='basket'),
     path('checkout/', checkout_view, name='checkout'),
+    path('checkout/regions/', regions_view, name='regions'),
     path('payment/', create_checkout_session, name='payment'),
     path('success/', success_payment, name='success'),
     path('profile/', profile_customer_view, name='profile'),
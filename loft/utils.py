@@ -1,17 +1,38 @@
-from .models import Cart, ProductCart, Product, Customer, Order, ProductOrder
+import hashlib
+
+from django.contrib import messages
+from django.db import transaction
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.db.models import Prefetch, Q, F, Case, When, Value, IntegerField, Sum
+
+from .bestsellers import add_sales
+from .caching import get_category_tree
+from .related import build_related
+from .storage import retain
+from .models import Cart, ProductCart, Product, Order, ProductOrder, FavoriteProduct, ImagesProduct
+
+
+# Исключение, когда товара на складе меньше, чем в корзине
+class OutOfStockError(Exception):
+    pass
 
 # Класс с матода для работы с корзиной
 class CartForAuthenticatedUser:
     def __init__(self, request, slug=None, action=None):
         self.user = request.user
+        self.session = getattr(request, 'session', None)
         if slug and action:
             self.add_or_delete(slug, action)
 
     # Метод для получения информации о крзине и её товарах
     def get_cart_info(self):
-        customer = Customer.objects.get(user=self.user)  # Получаем покупателя
-        cart = Cart.objects.get(customer=customer)  # Получаем корзину покупателя
-        products_cart = cart.productcart_set.all()
+        cart = Cart.objects.select_related('customer').get(customer__user=self.user)  # Корзина вместе с покупателем
+        customer = cart.customer
+        images = ImagesProduct.objects.order_by('pk')
+        products_cart = cart.productcart_set.select_related('product').prefetch_related(
+            Prefetch('product__images', queryset=images)).order_by('pk')
         return {
             'cart': cart,
             'products_cart': products_cart,
@@ -20,50 +41,103 @@ class CartForAuthenticatedUser:
             'customer': customer
         }
 
-    # Метод добавления товара в корзину, изменения его кол-ва удаления и очищения
-    def add_or_delete(self, slug, action):
-        cart = self.get_cart_info()['cart']
-        product = Product.objects.get(slug=slug)
-        product_cart, created = ProductCart.objects.get_or_create(cart=cart, product=product)  # Получить или создать
+    # Метод для получения id корзины: из сессии, а при первом обращении - одним запросом по пользователю
+    def get_cart_id(self):
+        cached = self.session.get('cart_id') if self.session is not None else None
+        if cached and cached[0] == self.user.pk:
+            return cached[1]
+        cart_id = Cart.objects.filter(customer__user=self.user).values_list('pk', flat=True).first()
+        if cart_id is None:
+            raise Cart.DoesNotExist
+        if self.session is not None:
+            self.session['cart_id'] = [self.user.pk, cart_id]
+        return cart_id
+
+    # Метод для получения кол-ва и стоимости товара в корзине вместе с итогами всей корзины
+    def get_line_info(self, slug):
+        cart = Cart(pk=self.get_cart_id())
+        p_cart = cart.productcart_set.select_related('product').filter(product__slug=slug).first()
+        return {
+            'quantity': p_cart.quantity if p_cart else 0,
+            'line_total': p_cart.get_total_price if p_cart else 0,
+            'line_old_total': p_cart.get_old_price if p_cart else 0,
+            'cart_total': cart.cart_total_price,
+            'cart_quantity': cart.cart_total_quantity,
+        }
 
-        if action == 'add' and product.quantity > 0 and product_cart.quantity < product.quantity:
-            product_cart.quantity += 1
+    # Метод добавления товара в корзину, изменения его кол-ва удаления и очищения.
+    # Каждое действие - условный UPDATE или DELETE строки корзины, строка создаётся только при добавлении
+    def add_or_delete(self, slug, action):
+        cart_id = self.get_cart_id()
+        line = ProductCart.objects.filter(cart_id=cart_id, product__slug=slug)
+
+        if action == 'add':
+            # Увеличиваем кол-во, пока оно меньше остатка на складе
+            if line.filter(quantity__lt=F('product__quantity')).update(quantity=F('quantity') + 1,
+                                                                      updated_at=timezone.now()):
+                return
+            product = Product.objects.filter(slug=slug).values('pk', 'quantity').first()
+            if product is None:
+                raise Product.DoesNotExist
+            if product['quantity'] > 0:
+                # Если строка уже есть (кол-во упёрлось в остаток), вставка пропускается
+                ProductCart.objects.bulk_create([ProductCart(cart_id=cart_id, product_id=product['pk'], quantity=1)],
+                                                ignore_conflicts=True)
         elif action == 'delete':
-            product_cart.quantity -= 1
-
+            if not line.filter(quantity__gt=1).update(quantity=F('quantity') - 1, updated_at=timezone.now()):
+                line.delete()
         elif action == 'clear':
-            product_cart.quantity = 0
-
-        product_cart.save()
+            line.delete()
 
-        if product_cart.quantity <= 0:
-            product_cart.delete()
-
-    # Метод сохранения и создания заказа покупателя
+    # Метод сохранения заказа покупателя: в одной транзакции списываем остатки,
+    # сохраняем товары заказа и очищаем корзину. Если товара не хватает - OutOfStockError
     def save_order(self, delivery):
-        data = self.get_cart_info()
-        order = Order.objects.create(customer=data['customer'], delivery=delivery,
-                                     price=data['cart_price'], cart=data['cart'])
-        order.save()
-        for p_cart in data['products_cart']:
-            product_order = ProductOrder.objects.create(order=order, name=p_cart.product.title,
-                                                        slug=p_cart.product.slug,
-                                                        price=p_cart.product.get_price(),
-                                                        photo=p_cart.product.first_photo(),
-                                                        total_price=p_cart.get_total_price, quantity=p_cart.quantity)
-            product_order.save()
-
-    # Метод очистки корзины
+        with transaction.atomic():
+            # Блокируем корзину, чтобы повторная оплата той же корзины ждала окончания этой
+            cart = Cart.objects.select_for_update(of=('self',)).select_related('customer').get(
+                customer__user=self.user)
+            images = ImagesProduct.objects.order_by('pk')
+            products_cart = list(cart.productcart_set.select_related('product').prefetch_related(
+                Prefetch('product__images', queryset=images)).order_by('pk'))
+            if not products_cart:
+                return None
+
+            # Списываем остатки одним UPDATE и только у тех товаров, которых хватает
+            in_stock = Q()
+            decrement = []
+            for p_cart in products_cart:
+                in_stock |= Q(pk=p_cart.product_id, quantity__gte=p_cart.quantity)
+                decrement.append(When(pk=p_cart.product_id, then=Value(p_cart.quantity)))
+            updated = Product.objects.filter(in_stock).update(
+                quantity=F('quantity') - Case(*decrement, default=Value(0), output_field=IntegerField()),
+                updated_at=timezone.now())
+            if updated != len(products_cart):
+                raise OutOfStockError()
+
+            # Заказ ссылается на тот же файл фото, что и товар, файл не копируется
+            photos = {}
+            for p_cart in products_cart:
+                image = p_cart.product.first_image()
+                photos[p_cart.pk] = image.image.name if image else ''
+            order = Order.objects.create(customer=cart.customer, delivery=delivery,
+                                         price=sum(p_cart.get_total_price for p_cart in products_cart), cart=cart,
+                                         line_count=len(products_cart), cover_photo=photos[products_cart[0].pk])
+            ProductOrder.objects.bulk_create([
+                ProductOrder(order=order, name=p_cart.product.title, slug=p_cart.product.slug,
+                             price=p_cart.product.get_price(), photo=photos[p_cart.pk],
+                             total_price=p_cart.get_total_price, quantity=p_cart.quantity)
+                for p_cart in products_cart
+            ])
+            retain(photos.values())  # bulk_create не вызывает сигналы, ссылки на фото учитываем сами
+            ProductCart.objects.filter(cart=cart).delete()
+            add_sales({p_cart.product_id: p_cart.quantity for p_cart in products_cart})
+            # Новые пары «купили вместе» пересчитываем только для товаров заказа, в фоновой задаче
+            build_related.delay([p_cart.product_id for p_cart in products_cart])
+            return order
+
+    # Метод очистки корзины одним запросом
     def clear_cart(self):
-        cart = self.get_cart_info()['cart']
-        products_cart = cart.productcart_set.all()
-        for p_cart in products_cart:
-            product = p_cart.product
-            product.quantity -= p_cart.quantity
-            product.save()
-            p_cart.delete()
-
-        cart.save()
+        ProductCart.objects.filter(cart_id=self.get_cart_id()).delete()
 
 
 
@@ -74,7 +148,101 @@ def cart_info(request):
     return info
 
 
-
-
-
-
+# Функция для получения множества id избранных товаров, кэшируется на объекте запроса
+def get_favorite_ids(request):
+    if not hasattr(request, '_favorite_ids'):
+        if request.user.is_authenticated:
+            favorites = FavoriteProduct.objects.filter(user=request.user).values_list('product_id', flat=True)
+            request._favorite_ids = set(favorites)
+        else:
+            request._favorite_ids = set()
+    return request._favorite_ids
+
+
+# Функция сброса кэша избранного после его изменения
+def reset_favorite_ids(request):
+    request.__dict__.pop('_favorite_ids', None)
+
+
+# Функция для получения кол-ва товаров в корзине для значка в шапке
+def get_cart_quantity(request):
+    if not request.user.is_authenticated:
+        return 0
+    totals = ProductCart.objects.filter(cart__customer__user=request.user).aggregate(quantity=Sum('quantity'))
+    return totals['quantity'] or 0
+
+
+# Миксин для условных GET-запросов анонимных посетителей: если страница не изменилась
+# с прошлого визита, отвечаем 304 без выборки товаров и рендеринга шаблона.
+# Наследник задаёт get_last_modified() и/или get_etag() - строку, из которой считается ETag.
+# Cache-Control: no-cache не даёт браузеру показывать сохранённую страницу со старыми ценами
+# и остатками без проверки, страницы авторизованных ещё и private
+class ConditionalGetMixin:
+    def get_last_modified(self):
+        return None
+
+    def get_etag(self):
+        return None
+
+    def get(self, request, *args, **kwargs):
+        # У авторизованных на странице избранное и корзина, а неполученные сообщения нельзя потерять
+        if request.user.is_authenticated or len(messages.get_messages(request)):
+            response = super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+            patch_cache_control(response, no_cache=True)
+            if request.user.is_authenticated:
+                patch_cache_control(response, private=True)
+            return response
+
+        self.last_modified = self.get_last_modified()
+        timestamp = int(self.last_modified.timestamp()) if self.last_modified else None
+        etag = self.get_etag()
+        etag = quote_etag(hashlib.md5(etag.encode()).hexdigest()) if etag else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        if etag:
+            response.headers.setdefault('ETag', etag)
+        if timestamp:
+            response.headers.setdefault('Last-Modified', http_date(timestamp))
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+# Варианты сортировки каталога, цена - с учётом скидки
+SORT_OPTIONS = {
+    'price': ('final_price', 'pk'),
+    '-price': ('-final_price', '-pk'),
+    'new': ('-created_at', '-pk'),
+}
+
+
+# Функция фильтрации товаров по запросам из парметров, параметры из exclude пропускаются
+def filter_products(request, products, exclude=()):
+    params = {key: value for key, value in request.GET.items() if key not in exclude}
+    cat = params.get('cat')
+    price_from = params.get('price_from')
+    price_to = params.get('price_to')
+    model = params.get('model')
+    color = params.get('color')
+    sort = params.get('sort')
+
+    if cat:
+        # Подкатегория вместе со всеми вложенными в неё категориями
+        node = get_category_tree().by_slug.get(cat)
+        if node:
+            products = products.filter(category__path__startswith=node.path)
+        else:
+            products = products.none()
+    if price_from:
+        products = products.filter(final_price__gte=price_from)
+    if price_to:
+        products = products.filter(final_price__lte=price_to)
+    if model:
+        products = products.filter(model__slug=model)
+    if color:
+        products = products.filter(color_name=color)
+    if sort in SORT_OPTIONS:
+        products = products.order_by(*SORT_OPTIONS[sort])
+
+    return products
@@ -1,16 +1,41 @@
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.db.models import Prefetch, Window, Q, Max, Count
+from django.db.models.functions import RowNumber
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, redirect
 from .models import *
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_POST, condition
 from django.views.generic import ListView, DetailView, CreateView
 from .forms import LoginForm, RegisterForm, DeliveryForm, EditAccountForm, EditCustomerForm, ContactForm
 from django.contrib.auth import login, logout
 from django.contrib import messages
 # Create your views here.
-from .tests import filter_products
+from .utils import filter_products
 from django.contrib.auth.mixins import LoginRequiredMixin
-from .utils import CartForAuthenticatedUser, cart_info
+from .bestsellers import get_bestsellers
+from .caching import category_tree_state, get_category_tree, get_regions, regions_version
+from .facets import get_facets
+from .pagination import CursorPaginationMixin
+from .related import get_related, related_state
+from .search import search_products
+from .utils import CartForAuthenticatedUser, ConditionalGetMixin, OutOfStockError, cart_info, reset_favorite_ids
 import stripe
-from store.settings import STRIPE_SECRET_KEY
+from asgiref.sync import sync_to_async
+from .payments import (checkout_session_params, clear_checkout_nonce, create_stripe_session, get_checkout_nonce,
+                       idempotency_key)
+
+# Сколько браузер хранит справочник регионов без повторного запроса
+REGIONS_MAX_AGE = 60 * 60 * 24
+
+
+# Строка для ETag списка товаров: последнее изменение и кол-во товаров (ловит удаление),
+# параметры фильтра и страницы, состояние дерева категорий для навигации
+def listing_etag(request, products):
+    state = products.aggregate(last=Max('updated_at'), count=Count('pk'))
+    params = sorted(request.GET.lists())
+    return f'{state["last"]}:{state["count"]}:{params}:{category_tree_state()}'
 
 
 class MainPage(ListView):
@@ -18,22 +43,55 @@ class MainPage(ListView):
     context_object_name = 'categories'
     template_name = 'loft/index.html'
     extra_context = {'title': 'LOFT МЕБЕЛЬ КОМФОРТА'}
+    bestsellers_limit = 8
 
     def get_queryset(self):
-        categories = Category.objects.filter(parent=None)
+        categories = get_category_tree().roots
         return categories
 
+    # Хиты продаж из предрассчитанной таблицы, пока продаж нет - по два новых товара из каждой подкатегории
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super(MainPage, self).get_context_data()
+        context['products'] = list(get_bestsellers(self.bestsellers_limit))
+        if not context['products']:
+            subcats = [subcat.pk for category in context['categories'] for subcat in category.children]
+            products = Product.objects.for_cards().filter(category_id__in=subcats).annotate(
+                row=Window(RowNumber(), partition_by='category', order_by='-pk')).filter(row__lte=2)
+            context['products'] = sorted(products, key=lambda p: (subcats.index(p.category_id), p.row))
+        return context
+
 
-class ProductDetail(DetailView):
+class ProductDetail(ConditionalGetMixin, DetailView):
     model = Product
     context_object_name = 'product'
+    colors_limit = 20
+
+    def get_queryset(self):
+        return Product.objects.for_cards()
+
+    # Страница меняется вместе с товаром, товарами той же модели (выбор цвета) и похожими товарами
+    # (из индекса или той же родительской категории)
+    def get_last_modified(self):
+        product = Product.objects.filter(slug=self.kwargs['slug']).values('pk', 'model', 'category__parent').first()
+        if product is None:
+            return None
+        same = (Q(pk=product['pk']) | Q(model=product['model']) | Q(related_to__product=product['pk']) |
+                Q(category__parent=product['category__parent']))
+        return Product.objects.filter(same).aggregate(last=Max('updated_at'))['last']
+
+    def get_etag(self):
+        if self.last_modified is None:
+            return None
+        return f'{self.last_modified.isoformat()}:{category_tree_state()}:{related_state(self.kwargs["slug"])}'
 
     def get_context_data(self, **kwargs):
         context = super(ProductDetail, self).get_context_data()
         product = context['product']
         context['title'] = product.title
-        context['same_models'] = Product.objects.filter(model=product.model)
-        context['same_products'] = Product.objects.filter(category__parent=product.category.parent).exclude(pk=product.pk)
+        context['breadcrumbs'] = get_category_tree().ancestors(product.category_id)
+        context['same_models'] = Product.objects.filter(model=product.model).only(
+            'slug', 'color_code')[:self.colors_limit]
+        context['same_products'] = get_related(product)
 
         return context
 
@@ -96,62 +154,91 @@ def register_user_view(request):
         return redirect('main')
 
 
-class ProductByCategory(ListView):
+class ProductByCategory(ConditionalGetMixin, CursorPaginationMixin, ListView):
     model = Product
     context_object_name = 'products'
     template_name = 'loft/category.html'
     paginate_by = 4
 
+    def get_category(self):
+        category = get_category_tree().by_slug.get(self.kwargs['slug'])
+        if category is None:
+            raise Http404('Категория не найдена')
+        return category
+
+    # Страница меняется вместе с любым товаром категории, параметрами фильтра и навигацией
+    def get_etag(self):
+        products = Product.objects.filter(category__path__startswith=self.get_category().path)
+        return listing_etag(self.request, products)
+
+    # Товары категории на любой глубине вложенности, категория берётся из кэшированного дерева
     def get_queryset(self):
-        category = Category.objects.get(slug=self.kwargs['slug'])
-        products = Product.objects.filter(category__in=category.subcategories.all())
-        products = filter_products(self.request, products)
+        self.category = self.get_category()
+        self.category_products = Product.objects.filter(category__path__startswith=self.category.path)
+        products = filter_products(self.request, self.category_products.for_cards().order_by('pk'))
         return products
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super(ProductByCategory, self).get_context_data()
-        category = Category.objects.get(slug=self.kwargs['slug'])
-        context['title'] = category.title
-        context['subcats'] = category.subcategories.all()
-        context['prices'] = [i for i in range(500, 100001, 500)]
-        products = Product.objects.filter(category__slug=self.request.GET.get('cat'))
-        context['models'] = set([i.model for i in products])
+        context['title'] = self.category.title
+        context['subcats'] = self.category.children
+        context['facets'] = get_facets(self.request, self.category_products)
 
         return context
 
 
 
 # Вьюшка для страницы товаров по акции
-class SalesProducts(ListView):
+class SalesProducts(ConditionalGetMixin, CursorPaginationMixin, ListView):
     model = Product
     context_object_name = 'products'
     extra_context = {'title': 'Товары по акции'}
     paginate_by = 2
 
+    def get_etag(self):
+        return listing_etag(self.request, Product.objects.filter(discount__gt=0))
+
     def get_queryset(self):
-        products = Product.objects.filter(discount__gt=0).order_by('-created_at')
+        products = Product.objects.for_cards().filter(discount__gt=0).order_by('-created_at', '-pk')
         return products
 
 
+# Вьюшка для поиска товаров из шапки сайта
+class SearchProducts(ListView):
+    context_object_name = 'products'
+    template_name = 'loft/product_list.html'
+    paginate_by = 8
+
+    def get_queryset(self):
+        query = self.request.GET.get('q', '').strip()
+        if not query:
+            return []
+        return search_products(query)
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super(SearchProducts, self).get_context_data()
+        context['title'] = f'Поиск: {self.request.GET.get("q", "").strip()}'
+        return context
+
+
 @login_required(login_url='auth')
 def save_favorite_product(request, slug):
     user = request.user
-    product = Product.objects.get(slug=slug)
-    favorites = FavoriteProduct.objects.filter(user=user)
+    deleted, _ = FavoriteProduct.objects.filter(user=user, product__slug=slug).delete()
 
-    if product in [i.product for i in favorites]:
-        fav = FavoriteProduct.objects.get(user=user, product=product)
-        fav.delete()
-    else:
+    if not deleted:
+        product = Product.objects.get(slug=slug)
         FavoriteProduct.objects.create(user=user, product=product)
 
+    reset_favorite_ids(request)
+
     next_page = request.META.get('HTTP_REFERER', 'main')
     return redirect(next_page)
 
 
 
 class FavoriteList(LoginRequiredMixin, ListView):
-    model = FavoriteProduct
+    model = Product
     context_object_name = 'products'
     template_name = 'loft/product_list.html'
     extra_context = {'title': 'Избранные товары'}
@@ -159,9 +246,8 @@ class FavoriteList(LoginRequiredMixin, ListView):
     login_url = 'auth'
 
     def get_queryset(self):
-        products = FavoriteProduct.objects.filter(user=self.request.user)
-        products = [i.product for i in products]
-        return products
+        products = Product.objects.for_cards().filter(favoriteproduct__user=self.request.user)
+        return products.order_by('favoriteproduct__created_at')
 
 
 # Вьюшка для добавления или удаления товраа из корзины
@@ -172,6 +258,28 @@ def add_or_delete_view(request, slug, action):
     return redirect(next_page)
 
 
+# Вьюшка для изменения корзины без перезагрузки страницы, возвращает новые итоги в JSON
+@require_POST
+def cart_api_view(request, slug, action):
+    if not request.user.is_authenticated:
+        return JsonResponse({'login_url': reverse('auth')}, status=401)
+    if action not in ('add', 'delete', 'clear'):
+        return JsonResponse({'error': 'Неизвестное действие'}, status=400)
+    try:
+        user_cart = CartForAuthenticatedUser(request, slug, action)
+    except Product.DoesNotExist:
+        return JsonResponse({'error': 'Товар не найден'}, status=404)
+    return JsonResponse(user_cart.get_line_info(slug))
+
+
+# Справочник городов по регионам в JSON. Адрес содержит версию справочника, поэтому браузер
+# может хранить ответ долго, а после изменения регионов получит новый адрес
+@cache_control(public=True, max_age=REGIONS_MAX_AGE)
+@condition(etag_func=lambda request: regions_version())
+def regions_view(request):
+    return JsonResponse(get_regions())
+
+
 @login_required(login_url='auth')
 def my_cart_view(request):
     cart = cart_info(request)
@@ -179,7 +287,8 @@ def my_cart_view(request):
         'title': 'Корзина',
         'products_cart': cart['products_cart'],
         'cart_price': cart['cart_price'],
-        'cart_quantity': cart['cart_quantity']
+        'cart_quantity': cart['cart_quantity'],
+        'cart_badge': cart['cart_quantity'],  # значок уже посчитан, не делаем лишний запрос
     }
     return render(request, 'loft/my_cart.html', context)
 
@@ -188,15 +297,16 @@ def my_cart_view(request):
 def checkout_view(request):
     cart = cart_info(request)
     if cart['products_cart'] and request.method == 'POST':
-        regions = Region.objects.all()
-        dict_city = {i.pk: [[j.name, j.pk] for j in i.cities.all()] for i in regions}
+        form = DeliveryForm()
+        form.fields['city'].queryset = City.objects.none()  # города подгружаются скриптом из regions_view
+        get_checkout_nonce(request.session)
 
         context = {
             'products_cart': cart['products_cart'],
             'cart': cart['cart'],
             'title': 'Оформление заказа',
-            'form': DeliveryForm(),
-            'dict_city': dict_city
+            'form': form,
+            'regions_version': regions_version()
         }
 
         return render(request, 'loft/checkout.html', context)
@@ -204,30 +314,35 @@ def checkout_view(request):
         return redirect('main')
 
 
-@login_required(login_url='auth')
-def create_checkout_session(request):
-    stripe.api_key = STRIPE_SECRET_KEY
-    if request.method == 'POST':
-        cart = cart_info(request)
-        price = cart['cart_price']
+# Подготовка оплаты: корзина, параметры сессии и ключ идемпотентности. Работает с базой и сессией,
+# поэтому из асинхронной вьюшки вызывается через sync_to_async
+def prepare_checkout(request):
+    cart = cart_info(request)
+    products_cart = list(cart['products_cart'])
+    if not products_cart:
+        return None
+    request.session[f'form_{request.user.pk}'] = request.POST
+    price = cart['cart_price']
+    key = idempotency_key(cart['cart'], products_cart, price, get_checkout_nonce(request.session))
+    return checkout_session_params(request, products_cart, price), key
 
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'rub',
-                    'product_data': {'name': ',\n'.join(i.product.title for i in cart['products_cart']) },
-                    'unit_amount': int(price) * 100
-                },
-                'quantity': 1
-            }],
-            mode='payment',
-            success_url=request.build_absolute_uri(reverse('success')),
-            cancel_url=request.build_absolute_uri(reverse('checkout'))
-        )
 
-        request.session[f'form_{request.user.pk}'] = request.POST
-        return redirect(session.url)
+# Асинхронная вьюшка оплаты: под ASGI (store/asgi.py) ожидание ответа Stripe не занимает воркер,
+# сам запрос к Stripe выполняется в пуле потоков с таймаутом и повторами из настроек
+@login_required(login_url='auth')
+async def create_checkout_session(request):
+    if request.method != 'POST':
+        return redirect('basket')
+    checkout = await sync_to_async(prepare_checkout)(request)
+    if checkout is None:
+        return redirect('main')
+
+    try:
+        session = await sync_to_async(create_stripe_session, thread_sensitive=False)(*checkout)
+    except stripe.StripeError:
+        messages.error(request, 'Платёжный сервис не отвечает, попробуйте ещё раз')
+        return redirect('basket')
+    return redirect(session.url)
 
 
 
@@ -243,13 +358,22 @@ def success_payment(request):
     if cart['products_cart'] and form:
         ship_form = DeliveryForm(data=form)
         if ship_form.is_valid():
-            delivery = ship_form.save(commit=False)
-            delivery.customer = Customer.objects.get(user=request.user)
-            delivery.save()
-
             cart_user = CartForAuthenticatedUser(request)
-            cart_user.save_order(delivery)
-            cart_user.clear_cart()
+            try:
+                with transaction.atomic():
+                    delivery = ship_form.save(commit=False)
+                    delivery.customer = cart['customer']
+                    delivery.save()
+                    order = cart_user.save_order(delivery)
+                    # Корзину успели очистить в другом запросе: доставку без заказа не сохраняем
+                    if order is None:
+                        transaction.set_rollback(True)
+            except OutOfStockError:
+                messages.error(request, 'Часть товаров закончилась на складе, проверьте корзину')
+                return redirect('basket')
+            if order is None:
+                return redirect('basket')
+            clear_checkout_nonce(request.session)
         else:
             return redirect('checkout')
 
@@ -273,7 +397,8 @@ def profile_customer_view(request):
         customer_form = EditCustomerForm(instance=request.user.customer)
         account_form = EditAccountForm(instance=request.user)
 
-    order = Order.objects.filter(customer=request.user.customer).last()
+    # Для последнего заказа хватает сводки из самого заказа, товары заказа не читаются
+    order = Order.objects.filter(customer=request.user.customer).order_by('-created_at', '-pk').first()
 
     context = {
         'title': f'Профиль {request.user.username}',
@@ -285,16 +410,23 @@ def profile_customer_view(request):
 
 
 
-class CustomerOrders(LoginRequiredMixin ,ListView):
+class CustomerOrders(LoginRequiredMixin, CursorPaginationMixin, ListView):
     model = Order
     context_object_name = 'orders'
     template_name = 'loft/orders.html'
     extra_context = {'title': 'История заказов'}
     login_url = 'auth'
+    paginate_by = 5
+    cursor_only = True
+    # Покупатель должен сразу видеть новый заказ в общем кол-ве, поэтому оно не кэшируется
+    cursor_count_timeout = 0
 
+    # Заказы страницами по ключу (дата, id), товары всех заказов страницы - одним запросом
     def get_queryset(self):
-        orders = Order.objects.filter(customer=self.request.user.customer)
-        return orders.order_by('-created_at')
+        products = ProductOrder.objects.only('order_id', 'name', 'price', 'quantity', 'total_price', 'photo')
+        orders = Order.objects.filter(customer=self.request.user.customer).prefetch_related(
+            Prefetch('products', queryset=products.order_by('pk')))
+        return orders.order_by('-created_at', '-pk')
 
 
 
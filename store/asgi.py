@@ -13,4 +13,7 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'store.settings')
 
+# Под ASGI-сервером (например, uvicorn store.asgi:application) асинхронная вьюшка оплаты
+# не занимает воркер, пока ждёт ответа Stripe
+
 application = get_asgi_application()
@@ -71,6 +71,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'loft.context_processors.favorites',
+                'loft.context_processors.cart',
             ],
         },
     },
@@ -90,6 +92,25 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Кэш дерева категорий и отрендеренных карточек товаров. LocMemCache у каждого процесса свой:
+# изменения, сделанные в другом процессе, видны здесь не позже LOFT_CACHE_VERSION_TTL секунд.
+# Для нескольких процессов лучше общий бэкенд, например django.core.cache.backends.redis.RedisCache,
+# тогда изменения видны сразу и LOFT_CACHE_VERSION_TTL можно поставить None
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'loft',
+    }
+}
+
+LOFT_CACHE_VERSION_TTL = 60
+# Срок самих закэшированных данных, должен быть больше срока версии
+LOFT_CACHE_DATA_TTL = 5 * 60
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -144,3 +165,11 @@ STRIPE_PUBLIC_KEY = ''
 
 STRIPE_SECRET_KEY = ''
 
+# Адрес API Stripe, для нагрузочных тестов - локальная заглушка (manage.py fake_stripe)
+STRIPE_API_BASE = 'https://api.stripe.com'
+
+# Таймаут одного запроса к Stripe в секундах и число повторов при сетевых ошибках
+STRIPE_TIMEOUT = 10
+
+STRIPE_MAX_RETRIES = 2
+